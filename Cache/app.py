@@ -1,13 +1,44 @@
 import redis
 import os
-import json
-import time
+import orjson
+import signal
+import threading
 import random
-from typing import Optional, Any, Dict
+import hashlib
+from bisect import bisect
+from typing import Optional, Any, Dict, List
 from dotenv import load_dotenv
 
 load_dotenv()
 
+class HashRing:
+    """Anillo de hashing consistente: asigna cada llave a un nodo Redis.
+    Los puntos virtuales salen de la identidad "host:port" del nodo y no de su posición en
+    REDIS_NODES, así quitar o reordenar un nodo solo mueve las llaves que eran de ese nodo"""
+    def __init__(self, nodes: Dict[str, redis.Redis], replicas: int = 100):
+        self.nodes = nodes
+        ring = []
+        for name in nodes:
+            for r in range(replicas):
+                ring.append((self._hash(f"{name}#{r}"), name))
+        ring.sort()
+        self._points = [p for p, _ in ring]
+        self._owners = [n for _, n in ring]
+        self._single = next(iter(nodes)) if len(nodes) == 1 else None
+
+    @staticmethod
+    def _hash(value: str) -> int:
+        return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+
+    def get_name(self, key: str) -> str:
+        if self._single is not None:
+            return self._single
+        pos = bisect(self._points, self._hash(key)) % len(self._points)
+        return self._owners[pos]
+
+    def get_node(self, key: str) -> redis.Redis:
+        return self.nodes[self.get_name(key)]
+
 class CacheManager:
     def __init__(self, max_keys: int = 500):
         self.redis_host = os.getenv('REDIS_HOST', 'localhost')
@@ -15,19 +46,33 @@ class CacheManager:
         self.cache_policy = os.getenv('CACHE_POLICY', 'LRU')
         self.cache_size = max_keys  # Máximo de llaves permitido
         self.cache_ttl = int(os.getenv('CACHE_TTL', 3600))
-        
-        # Conectar a Redis
-        self.redis_client = redis.Redis(
-            host=self.redis_host,
-            port=self.redis_port,
-            db=0,
-            decode_responses=True
-        )
-        
+
+        # Nodos Redis: REDIS_NODES="host1:6379,host2:6379" o un único REDIS_HOST:REDIS_PORT
+        nodes_env = os.getenv('REDIS_NODES', '')
+        self.redis_nodes = [n.strip() for n in nodes_env.split(',') if n.strip()] \
+            or [f"{self.redis_host}:{self.redis_port}"]
+
+        # Conectar a Redis (un cliente por shard, con un pool de conexiones acotado y compartido)
+        max_connections = int(os.getenv('REDIS_MAX_CONNECTIONS', 20))
+        self.redis_shards: Dict[str, redis.Redis] = {}  # "host:port" -> cliente
+        for node in self.redis_nodes:
+            host, _, port = node.partition(':')
+            port = int(port or 6379)
+            pool = redis.ConnectionPool(
+                host=host,
+                port=port,
+                db=0,
+                decode_responses=True,
+                max_connections=max_connections
+            )
+            self.redis_shards[f"{host}:{port}"] = redis.Redis(connection_pool=pool)
+        self.ring = HashRing(self.redis_shards)
+
         # Verificar conexión
         try:
-            self.redis_client.ping()
-            print(f"✅ Conectado a Redis en {self.redis_host}:{self.redis_port}")
+            for shard in self.redis_shards.values():
+                shard.ping()
+            print(f"✅ Conectado a Redis en {', '.join(self.redis_nodes)}")
             print(f"🔧 Política de caché: {self.cache_policy}")
             print(f"📊 Tamaño máximo: {self.cache_size} elementos")
             print(f"⏰ TTL: {self.cache_ttl} segundos")
@@ -35,56 +80,61 @@ class CacheManager:
             print("❌ Error al conectar con Redis")
             raise
 
+    def _client_for(self, key: str) -> redis.Redis:
+        return self.ring.get_node(key)
+
     def _get_cache_size(self) -> int:
-        return self.redis_client.dbsize()
+        return sum(shard.dbsize() for shard in self.redis_shards.values())
 
     def _evict_if_needed(self):
         """Eliminar elementos según la política si el caché excede el tamaño"""
         while self._get_cache_size() > self.cache_size:
+            # Se evicta desde el shard con más llaves
+            shard = max(self.redis_shards.values(), key=lambda s: s.dbsize())
             if self.cache_policy.upper() == 'LRU':
-                self._evict_lru()
+                self._evict_lru(shard)
             elif self.cache_policy.upper() == 'FIFO':
-                self._evict_fifo()
+                self._evict_fifo(shard)
             elif self.cache_policy.upper() == 'LFU':
-                self._evict_lfu()
+                self._evict_lfu(shard)
             else:
-                self._evict_random()
+                self._evict_random(shard)
 
-    def _evict_lru(self):
-        keys = self.redis_client.keys('*')
+    def _evict_lru(self, shard: redis.Redis):
+        keys = shard.keys('*')
         if keys:
             # Simplificado: eliminar la primera clave
-            self.redis_client.delete(keys[0])
+            shard.delete(keys[0])
             print(f"🗑️ Evicción LRU: {keys[0]}")
 
-    def _evict_fifo(self):
-        keys = self.redis_client.keys('*')
+    def _evict_fifo(self, shard: redis.Redis):
+        keys = shard.keys('*')
         if keys:
-            oldest_key = min(keys, key=lambda k: self.redis_client.object('idletime', k))
-            self.redis_client.delete(oldest_key)
+            oldest_key = min(keys, key=lambda k: shard.object('idletime', k))
+            shard.delete(oldest_key)
             print(f"🗑️ Evicción FIFO: {oldest_key}")
 
-    def _evict_lfu(self):
-        keys = self.redis_client.keys('*')
+    def _evict_lfu(self, shard: redis.Redis):
+        keys = shard.keys('*')
         if keys:
             # Simplificación: eliminar primera clave
-            self.redis_client.delete(keys[0])
+            shard.delete(keys[0])
             print(f"🗑️ Evicción LFU: {keys[0]}")
 
-    def _evict_random(self):
-        keys = self.redis_client.keys('*')
+    def _evict_random(self, shard: redis.Redis):
+        keys = shard.keys('*')
         if keys:
             key_to_delete = random.choice(keys)
-            self.redis_client.delete(key_to_delete)
+            shard.delete(key_to_delete)
             print(f"🗑️ Evicción Random: {key_to_delete}")
 
     def set(self, key: str, value: Any, ttl: Optional[int] = None) -> bool:
         try:
             self._evict_if_needed()
             if isinstance(value, (dict, list)):
-                value = json.dumps(value)
+                value = orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS)
             ttl = ttl if ttl else self.cache_ttl
-            result = self.redis_client.setex(key, ttl, value)
+            result = self._client_for(key).setex(key, ttl, value)
             if result:
                 print(f"✅ Almacenado: {key} (TTL={ttl}s)")
             return result
@@ -94,49 +144,95 @@ class CacheManager:
 
     def get(self, key: str) -> Optional[Any]:
         try:
-            value = self.redis_client.get(key)
+            value = self._client_for(key).get(key)
             if value is None:
                 print(f"🔍 Miss de caché: {key}")
                 return None
             print(f"✅ Hit de caché: {key}")
             try:
-                return json.loads(value)
-            except json.JSONDecodeError:
+                return orjson.loads(value)
+            except orjson.JSONDecodeError:
                 return value
         except Exception as e:
             print(f"❌ Error al obtener {key}: {e}")
             return None
 
+    def _group_by_shard(self, keys) -> Dict[str, List[str]]:
+        groups: Dict[str, List[str]] = {}
+        for key in keys:
+            groups.setdefault(self.ring.get_name(key), []).append(key)
+        return groups
+
+    def set_many(self, items: Dict[str, Any], ttl: Optional[int] = None) -> bool:
+        """Almacena varias llaves con un solo viaje (pipeline) por shard"""
+        try:
+            self._evict_if_needed()
+            ttl = ttl if ttl else self.cache_ttl
+            for name, keys in self._group_by_shard(items).items():
+                with self.redis_shards[name].pipeline(transaction=False) as pipe:
+                    for key in keys:
+                        value = items[key]
+                        if isinstance(value, (dict, list)):
+                            value = orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS)
+                        pipe.setex(key, ttl, value)
+                    pipe.execute()
+            print(f"✅ Almacenadas {len(items)} llaves (TTL={ttl}s)")
+            return True
+        except Exception as e:
+            print(f"❌ Error al almacenar {len(items)} llaves: {e}")
+            return False
+
+    def get_many(self, keys: List[str]) -> Dict[str, Optional[Any]]:
+        """Obtiene varias llaves con un solo MGET por shard; las ausentes quedan en None"""
+        results: Dict[str, Optional[Any]] = {key: None for key in keys}
+        try:
+            for name, shard_keys in self._group_by_shard(keys).items():
+                values = self.redis_shards[name].mget(shard_keys)
+                for key, value in zip(shard_keys, values):
+                    if value is None:
+                        continue
+                    try:
+                        results[key] = orjson.loads(value)
+                    except orjson.JSONDecodeError:
+                        results[key] = value
+            hits = sum(v is not None for v in results.values())
+            print(f"🔍 Caché: {hits} hits, {len(results) - hits} misses")
+        except Exception as e:
+            print(f"❌ Error al obtener {len(keys)} llaves: {e}")
+        return results
+
     def clear(self):
-        self.redis_client.flushdb()
+        for shard in self.redis_shards.values():
+            shard.flushdb()
         print("🧹 Caché limpio")
 
     def get_stats(self) -> Dict[str, Any]:
-        info = self.redis_client.info()
+        infos = [shard.info() for shard in self.redis_shards.values()]
         return {
             'current_size': self._get_cache_size(),
-            'memory_used': info.get('used_memory_human', 'N/A'),
-            'hits': info.get('keyspace_hits', 0),
-            'misses': info.get('keyspace_misses', 0)
+            'memory_used': ', '.join(info.get('used_memory_human', 'N/A') for info in infos),
+            'hits': sum(info.get('keyspace_hits', 0) for info in infos),
+            'misses': sum(info.get('keyspace_misses', 0) for info in infos)
         }
 
 def main():
     cache = CacheManager(max_keys=500)
 
     # Ejemplo inicial
-    cache.set("usuario:123", {"nombre": "Juan"})
-    cache.set("contador", 42)
+    cache.set_many({"usuario:123": {"nombre": "Juan"}, "contador": 42})
 
     print("\n🚀 Cache manager corriendo... Ctrl+C para detener.")
 
-    try:
-        while True:
-            time.sleep(10)
-            cache._evict_if_needed()  # Revisa y elimina si hace falta
-            stats = cache.get_stats()
-            print(f"📊 Tamaño: {stats['current_size']}, Hits: {stats['hits']}, Misses: {stats['misses']}")
-    except KeyboardInterrupt:
-        print("\n🛑 Cache manager detenido")
+    # Espera bloqueante en el kernel; SIGTERM/SIGINT despiertan el loop de inmediato
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+
+    while not stop.wait(10):
+        cache._evict_if_needed()  # Revisa y elimina si hace falta
+        stats = cache.get_stats()
+        print(f"📊 Tamaño: {stats['current_size']}, Hits: {stats['hits']}, Misses: {stats['misses']}")
+    print("\n🛑 Cache manager detenido")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -3,10 +3,14 @@ CREATE TABLE IF NOT EXISTS questions (
     question_text TEXT NOT NULL,
     human_answer TEXT NOT NULL,
     llm_answer TEXT,
+    grok_answer TEXT,  -- respuesta del batch de Grok (LLM_Client); llm_answer queda para el evaluador /evaluate
     similarity_score FLOAT,
     quality_score FLOAT,
     completeness_score FLOAT,
-    overall_score FLOAT,
+    -- Puntaje global derivado: lo calcula Postgres (NULL mientras falte algún puntaje)
+    overall_score FLOAT GENERATED ALWAYS AS (
+        similarity_score * 0.5 + quality_score * 0.3 + completeness_score * 0.2
+    ) STORED,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     evaluated_at TIMESTAMP
 );
@@ -19,7 +23,29 @@ CREATE TABLE IF NOT EXISTS cache_metrics (
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
-CREATE INDEX IF NOT EXISTS idx_question_text ON questions(question_text);
+-- Bases ya creadas antes de separar la respuesta de Grok
+ALTER TABLE questions ADD COLUMN IF NOT EXISTS grok_answer TEXT;
+
+-- Bases ya creadas con overall_score como columna normal: se reemplaza por la generada
+DO $$
+BEGIN
+    IF EXISTS (
+        SELECT 1 FROM information_schema.columns
+        WHERE table_name = 'questions' AND column_name = 'overall_score' AND is_generated = 'NEVER'
+    ) THEN
+        ALTER TABLE questions DROP COLUMN overall_score;
+        ALTER TABLE questions ADD COLUMN overall_score FLOAT GENERATED ALWAYS AS (
+            similarity_score * 0.5 + quality_score * 0.3 + completeness_score * 0.2
+        ) STORED;
+    END IF;
+END $$;
+
+-- Índice hash para búsquedas exactas por texto (un btree sobre TEXT falla con textos > ~2.7 KB)
+DROP INDEX IF EXISTS idx_question_text;
+CREATE INDEX IF NOT EXISTS idx_question_text_hash ON questions USING hash (question_text);
 CREATE INDEX IF NOT EXISTS idx_created_at ON questions(created_at);
 CREATE INDEX IF NOT EXISTS idx_overall_score ON questions(overall_score);
-CREATE INDEX IF NOT EXISTS idx_evaluated_at ON questions(evaluated_at);
\ No newline at end of file
+CREATE INDEX IF NOT EXISTS idx_evaluated_at ON questions(evaluated_at);
+-- Índice parcial: solo las preguntas aún sin respuesta de Grok (se achica a medida que LLM_Client responde)
+DROP INDEX IF EXISTS idx_questions_missing_llm;
+CREATE INDEX IF NOT EXISTS idx_questions_missing_grok ON questions(id) WHERE grok_answer IS NULL;
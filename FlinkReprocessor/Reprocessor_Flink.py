@@ -4,7 +4,7 @@ from pyflink.datastream.connectors.kafka import KafkaRecordSerializationSchema
 from pyflink.common.serialization import SimpleStringSchema
 from pyflink.common.typeinfo import Types
 from pyflink.common import Configuration
-import json
+import orjson
 
 BROKER = "kafka:9092"
 MAX_RETRIES = 3
@@ -40,12 +40,12 @@ sink = (
 
 # --- Lógica de reprocesamiento
 def reprocess_fails(value):
-    data = json.loads(value)
+    data = orjson.loads(value)
     retries = data.get("retries", 0)
     if retries < MAX_RETRIES:
         data["retries"] = retries + 1
         print(f"🔁 Reintentando ID={data['id']} (intento {data['retries']})")
-        return json.dumps(data)
+        return orjson.dumps(data).decode()
     else:
         print(f"❌ ID={data['id']} descartado tras 3 intentos")
         return None
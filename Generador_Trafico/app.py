@@ -1,9 +1,9 @@
 import os
 import time
-import json
+import asyncio
+import orjson
+import httpx
 import numpy as np
-import requests
-from datetime import datetime
 from confluent_kafka import Producer, KafkaException
 
 # --- Configuración de API y Kafka ---
@@ -12,6 +12,12 @@ API_URL = f"http://API_CLIENT:{API_PORT}/evaluate"
 
 KAFKA_BROKER = os.getenv("KAFKA_BROKER", "kafka:9092")
 TOPIC_PREGUNTAS = os.getenv("KAFKA_TOPIC_PREGUNTAS", "preguntas")
+MAX_CONCURRENCY = int(os.getenv("TRAFFIC_CONCURRENCY", 32))  # Requests a la API en vuelo a la vez
+
+# --- Rutas de salida (los logs quedan donde los busca graficador.py) ---
+BASE_DIR = os.path.dirname(__file__)
+DATA_DIR = os.path.join(BASE_DIR, "../data")
+GRAFICOS_DIR = os.path.join(DATA_DIR, "graficos")
 
 # --- Conexión robusta a Kafka ---
 producer = None
@@ -26,9 +32,9 @@ while not producer:
 def send_to_kafka(qid, retries=0):
     """Envía el ID (qid) al tópico de Kafka."""
     try:
-        payload = json.dumps({"id": qid, "retries": retries})
-        producer.produce(TOPIC_PREGUNTAS, payload.encode('utf-8'))
-        producer.flush()
+        payload = orjson.dumps({"id": qid, "retries": retries})
+        producer.produce(TOPIC_PREGUNTAS, payload)
+        producer.poll(0)  # entrega asíncrona: el flush se hace una sola vez al terminar
         print(f"📤 Enviada pregunta {qid} a Kafka topic '{TOPIC_PREGUNTAS}' (retries={retries})")
     except Exception as e:
         print(f"❌ Error enviando {qid} a Kafka: {e}")
@@ -42,74 +48,112 @@ class TrafficGenerator:
         self.start_id = start_id
         self.end_id = end_id
         self.distribution = distribution.lower()
-        self.responses = []
-        self.session = requests.Session()
+
+        # Logs y respuestas se escriben a disco a medida que llegan (nada se acumula en memoria)
+        os.makedirs(GRAFICOS_DIR, exist_ok=True)
+        self._log_f = open(os.path.join(GRAFICOS_DIR, f"traffic_logs_{self.distribution}.txt"), "w", encoding="utf-8")
+        self._resp_f = open(os.path.join(DATA_DIR, "traffic_responses.jsonl"), "ab")
 
         # Seguimiento de estados
         self.success = {}
         self.pending = set()
         self.failed = {}
         self.in_process = set()  # IDs que están siendo procesadas actualmente
+        self.retries = {}  # Reintentos por ID sin respuesta de la API
 
-    def sample_qid(self):
-        """Genera un ID de pregunta según la distribución seleccionada"""
+    def sample_qids(self, n):
+        """Genera n IDs de pregunta de una vez (vectorizado) según la distribución seleccionada"""
+        lo, hi = self.start_id, self.end_id
         if self.distribution == "uniform":
-            return int(np.random.randint(self.start_id, self.end_id + 1))
+            qids = np.random.randint(lo, hi + 1, size=n)
         elif self.distribution == "normal":
-            mean = (self.start_id + self.end_id) / 2
-            std = (self.end_id - self.start_id) / 6
-            return int(np.clip(int(np.random.normal(mean, std)), self.start_id, self.end_id))
+            qids = np.random.normal((lo + hi) / 2, (hi - lo) / 6, size=n).astype(int)
         elif self.distribution == "poisson":
-            lam = (self.start_id + self.end_id) / 2
-            return int(np.clip(int(np.random.poisson(lam)), self.start_id, self.end_id))
+            qids = np.random.poisson((lo + hi) / 2, size=n)
         elif self.distribution == "random":
-            return int(np.random.random() * (self.end_id - self.start_id + 1)) + self.start_id
+            qids = (np.random.random(n) * (hi - lo + 1)).astype(int) + lo
+        else:
+            raise ValueError(f"Distribución desconocida: {self.distribution}")
+        return np.clip(qids, lo, hi).tolist()
 
-    def get_from_api(self, qid, max_retries=3):
+    async def get_from_api(self, client, qid, max_retries=3):
         """Llama a la API para obtener la evaluación de la pregunta"""
         payload = {"id": qid}
         for attempt in range(1, max_retries + 1):
             try:
-                resp = self.session.post(API_URL, json=payload, timeout=60)
+                resp = await client.post(API_URL, content=orjson.dumps(payload))
                 resp.raise_for_status()
-                data = resp.json()
+                data = orjson.loads(resp.content)
                 return {"request": payload, "response": data}
             except Exception as e:
                 print(f"❌ Error llamando API para id={qid} (intento {attempt}): {e}")
-            time.sleep(2)
+            await asyncio.sleep(2)
         return {"request": payload, "response": None}
 
+    async def _run(self):
+        """Cada pasada lanza todas las pendientes a la vez (tope MAX_CONCURRENCY en vuelo);
+        el estado solo se toca desde el event loop, sin locks"""
+        sem = asyncio.Semaphore(MAX_CONCURRENCY)
+        async with httpx.AsyncClient(
+            timeout=60,
+            headers={"Content-Type": "application/json"},
+            limits=httpx.Limits(max_connections=MAX_CONCURRENCY, max_keepalive_connections=MAX_CONCURRENCY)
+        ) as client:
+            async def one(qid):
+                async with sem:
+                    return qid, await self.get_from_api(client, qid)
+
+            while self.pending:
+                tasks = []
+                for qid in list(self.pending):
+                    self.pending.discard(qid)
+                    self.in_process.add(qid)
+                    tasks.append(one(qid))
+
+                for next_done in asyncio.as_completed(tasks):
+                    qid, result = await next_done
+                    self._resp_f.write(orjson.dumps(result) + b"\n")
+                    self.in_process.discard(qid)
+                    response = result.get("response")
+                    overall = (response or {}).get("overall_score") or 0  # puede venir null
+
+                    if response is None:
+                        # Sin respuesta: se reenvía a Kafka y vuelve a pendientes hasta MAX_RETRIES veces
+                        retries = self.retries.get(qid, 0) + 1
+                        self.retries[qid] = retries
+                        if retries <= self.MAX_RETRIES:
+                            self.pending.add(qid)
+                            send_to_kafka(qid, retries=retries)
+                        else:
+                            self.failed[qid] = result
+                    elif overall >= self.SUCCESS_THRESHOLD:
+                        self.success[qid] = result
+                    else:
+                        self.failed[qid] = result
+
+                    line = f"ID={qid} | Overall={overall:.2f} | Pending={len(self.pending)} | In process={len(self.in_process)}"
+                    self._log_f.write(f"[{time.strftime('%H:%M:%S')}] {line}\n")
+                    print(line)
+                if self.pending:
+                    await asyncio.sleep(1)  # Espera antes de reintentar para no saturar la API
+
     def simulate_traffic(self, batch_size=5):
         """Simula el tráfico enviando IDs a Kafka y recolectando resultados"""
         # Agregar inicialmente batch de preguntas
-        for _ in range(batch_size):
-            qid = self.sample_qid()
+        for qid in self.sample_qids(batch_size):
             if qid not in self.pending and qid not in self.in_process:
                 self.pending.add(qid)
                 send_to_kafka(qid)
 
-        # Mientras haya preguntas pendientes o en proceso, seguir procesando
-        while self.pending or self.in_process:
-            for qid in list(self.pending):
-                self.pending.discard(qid)
-                self.in_process.add(qid)
-
-                result = self.get_from_api(qid)
-                self.responses.append(result)
-                overall = result.get("response", {}).get("overall_score", 0)
-
-                if overall >= self.SUCCESS_THRESHOLD:
-                    self.success[qid] = result
-                    self.in_process.discard(qid)
-                elif result.get("response") is None:
-                    # Si no hubo respuesta, se vuelve a enviar a Kafka
-                    send_to_kafka(qid, retries=0)
-                else:
-                    self.failed[qid] = result
-                    self.in_process.discard(qid)
-
-                print(f"ID={qid} | Overall={overall:.2f} | Pending={len(self.pending)} | In process={len(self.in_process)}")
-            time.sleep(1)  # Espera para no saturar la API
+        try:
+            asyncio.run(self._run())
+        finally:
+            producer.flush()
+            self._log_f.write(
+                f"Resumen: success={len(self.success)} failed={len(self.failed)} pending={len(self.pending)}\n"
+            )
+            self._log_f.close()
+            self._resp_f.close()
 
         print("✅ Todas las preguntas procesadas")
         return {
@@ -118,24 +162,13 @@ class TrafficGenerator:
             "failed": list(self.failed.values())
         }
 
-def convert_datetimes(obj):
-    """Convierte todos los datetime a ISO string"""
-    if isinstance(obj, dict):
-        return {k: convert_datetimes(v) for k, v in obj.items()}
-    elif isinstance(obj, list):
-        return [convert_datetimes(v) for v in obj]
-    elif isinstance(obj, datetime):
-        return obj.isoformat()
-    else:
-        return obj
-
 # --- Main ---
 if __name__ == "__main__":
     generator = TrafficGenerator(start_id=25000, end_id=30000, distribution="uniform")
     results = generator.simulate_traffic(batch_size=5)
 
-    results_clean = convert_datetimes(results)
-    with open("traffic_responses.json", "w", encoding="utf-8") as f:
-        json.dump(results_clean, f, ensure_ascii=False, indent=2)
+    # orjson serializa los datetime a ISO 8601 directamente
+    with open("traffic_responses.json", "wb") as f:
+        f.write(orjson.dumps(results, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
 
     print("📁 Resultados guardados en traffic_responses.json")
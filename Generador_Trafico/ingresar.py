@@ -1,7 +1,9 @@
+import io
 import os
 import json
+import orjson
 import psycopg2
-from psycopg2.extras import execute_values, RealDictCursor
+from psycopg2.extras import RealDictCursor
 from dotenv import load_dotenv
 
 # --- Cargar .env ---
@@ -27,50 +29,74 @@ try:
         user=DB_USER,
         password=DB_PASSWORD
     )
-    conn.autocommit = True
     print("✅ Conexión a PostgreSQL exitosa.")
 except Exception as e:
     print("❌ Error de conexión:", e)
     exit(1)
 
+# Tabla temporal de staging: COPY carga los lotes ahí y un solo INSERT ... SELECT hace el upsert
+STAGE_DDL = """
+CREATE TEMP TABLE IF NOT EXISTS questions_stage (
+    id INTEGER,
+    question_text TEXT,
+    human_answer TEXT,
+    grok_answer TEXT,
+    similarity_score FLOAT,
+    quality_score FLOAT,
+    completeness_score FLOAT,
+    created_at TIMESTAMP,
+    evaluated_at TIMESTAMP
+)
+"""
+
+def _copy_value(v):
+    """Formatea un valor para COPY en formato texto (NULL = \\N, escapa \\, tab y saltos de línea)"""
+    if v is None:
+        return "\\N"
+    return str(v).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
 def upsert_questions(data):
-    records = []
+    buf = io.StringIO()
     for item in data:
         entry = item["entry"]
-        records.append((
+        row = (
             int(item["key"]),
             entry.get("question_text"),
             entry.get("human_answer"),
-            entry.get("llm_answer"),
+            entry.get("llm_answer"),  # en los JSON de Grok la respuesta viene como llm_answer
             entry.get("similarity_score"),
             entry.get("quality_score"),
             entry.get("completeness_score"),
-            entry.get("overall_score"),
             entry.get("created_at"),
             entry.get("evaluated_at")
-        ))
+        )
+        buf.write("\t".join(_copy_value(v) for v in row))
+        buf.write("\n")
+    buf.seek(0)
 
     query = """
     INSERT INTO questions (
-        id, question_text, human_answer, llm_answer,
-        similarity_score, quality_score, completeness_score, overall_score,
+        id, question_text, human_answer, grok_answer,
+        similarity_score, quality_score, completeness_score,
         created_at, evaluated_at
     )
-    VALUES %s
+    SELECT * FROM questions_stage
     ON CONFLICT (id) DO UPDATE SET
-        llm_answer = EXCLUDED.llm_answer,
+        grok_answer = EXCLUDED.grok_answer,
         similarity_score = EXCLUDED.similarity_score,
         quality_score = EXCLUDED.quality_score,
         completeness_score = EXCLUDED.completeness_score,
-        overall_score = EXCLUDED.overall_score,
         evaluated_at = EXCLUDED.evaluated_at,
         question_text = CASE WHEN questions.question_text IS NULL OR questions.question_text = '' THEN EXCLUDED.question_text ELSE questions.question_text END,
         human_answer = CASE WHEN questions.human_answer IS NULL OR questions.human_answer = '' THEN EXCLUDED.human_answer ELSE questions.human_answer END
     ;
     """
     with conn.cursor() as cur:
-        execute_values(cur, query, records)
-    print(f"✅ Insert/Update de {len(records)} preguntas completado.")
+        cur.execute(STAGE_DDL)
+        cur.copy_expert("COPY questions_stage FROM STDIN", buf)
+        cur.execute(query)
+        cur.execute("TRUNCATE questions_stage")
+    print(f"✅ Insert/Update de {len(data)} preguntas completado.")
 
 def generate_column_counts_json():
     """Genera un JSON con la cantidad de registros no nulos por columna"""
@@ -81,6 +107,7 @@ def generate_column_counts_json():
                 COUNT(question_text) as question_text,
                 COUNT(human_answer) as human_answer,
                 COUNT(llm_answer) as llm_answer,
+                COUNT(grok_answer) as grok_answer,
                 COUNT(similarity_score) as similarity_score,
                 COUNT(quality_score) as quality_score,
                 COUNT(completeness_score) as completeness_score,
@@ -105,31 +132,40 @@ def upsert_json_file(file_path):
         print(f"❌ No se encontró {file_path}, saltando.")
         return 0
 
-    if file_path.endswith(".jsonl"):
-        with open(file_path, "r", encoding="utf-8") as f:
-            for line in f:
-                line = line.strip()
-                if not line:
-                    continue
-                obj = json.loads(line)
-                batch.append(obj)
-                total_count += 1
-                if len(batch) >= batch_size:
-                    upsert_questions(batch)
-                    batch.clear()
-    else:
-        with open(file_path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            for key, entry in data.items():
-                batch.append({"key": key, "entry": entry})
-                total_count += 1
-                if len(batch) >= batch_size:
-                    upsert_questions(batch)
-                    batch.clear()
-
-    if batch:
-        upsert_questions(batch)
+    # Todo el archivo va en una sola transacción: si algo falla se deshace entera
+    # y la conexión queda usable para el siguiente archivo
+    try:
+        if file_path.endswith(".jsonl"):
+            with open(file_path, "rb") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    obj = orjson.loads(line)
+                    batch.append(obj)
+                    total_count += 1
+                    if len(batch) >= batch_size:
+                        upsert_questions(batch)
+                        batch.clear()
+        else:
+            with open(file_path, "rb") as f:
+                data = orjson.loads(f.read())
+                for key, entry in data.items():
+                    batch.append({"key": key, "entry": entry})
+                    total_count += 1
+                    if len(batch) >= batch_size:
+                        upsert_questions(batch)
+                        batch.clear()
+
+        if batch:
+            upsert_questions(batch)
+    except Exception as e:
+        conn.rollback()
+        print(f"❌ Error cargando {os.path.basename(file_path)}, se hizo rollback: {e}")
+        return 0
 
+    # Un solo commit por archivo en vez de uno por lote
+    conn.commit()
     return total_count
 
 def main():
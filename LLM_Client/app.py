@@ -1,20 +1,49 @@
 import os
-import requests
-import json
+import sys
+import glob
+import time
+import random
+import asyncio
+import collections
+import csv
+import io
+import hashlib
+import httpx
+import orjson
+import msgspec
 import psycopg2
-from itertools import cycle
 from datetime import datetime
-import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from threading import Lock
 import shutil  # <-- para mover archivos
+try:
+    import uvloop  # loop en C (libuv): más rápido que el de asyncio para el fan-out de llamadas
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+except ImportError:
+    pass
 # --- Configuración API Keys ---
 API_KEYS = [k.strip() for k in os.getenv("OPENROUTER_API_KEY", "").split(",") if k.strip()]
 if not API_KEYS:
     raise ValueError("No se encontraron API keys en OPENROUTER_API_KEY")
-api_keys_cycle = cycle(API_KEYS)  # ciclo infinito de keys
 
-lock = Lock()  # Para acceso thread-safe a grok_answers
+WORKER_COUNT = int(os.getenv("WORKER_COUNT", 1))  # Instancias de LLM_Client repartiéndose las preguntas
+WORKER_ID = int(os.getenv("WORKER_ID", 0))        # Índice de esta instancia (0 .. WORKER_COUNT-1)
+if WORKER_COUNT < 1 or not 0 <= WORKER_ID < WORKER_COUNT:
+    raise ValueError(f"WORKER_ID debe estar entre 0 y WORKER_COUNT-1 (WORKER_ID={WORKER_ID}, WORKER_COUNT={WORKER_COUNT})")
+# Con varios workers cada uno usa en exclusiva su parte de las keys: el RateState de cada proceso
+# no ve el consumo de los otros, así que compartir una key entre workers no se permite
+if len(API_KEYS) < WORKER_COUNT:
+    raise ValueError(f"Hay {len(API_KEYS)} API keys para {WORKER_COUNT} workers: se necesita al menos una key por worker")
+API_KEYS = API_KEYS[WORKER_ID::WORKER_COUNT]
+
+OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
+
+MAX_CONCURRENCY = int(os.getenv("MAX_CONCURRENCY", 10))  # Llamadas a Grok en vuelo a la vez
+
+# Cliente HTTP asíncrono compartido: reutiliza la conexión TLS (HTTP/2) entre todas las llamadas
+http_client = httpx.AsyncClient(
+    http2=True,
+    timeout=30.0,
+    limits=httpx.Limits(max_connections=MAX_CONCURRENCY, max_keepalive_connections=MAX_CONCURRENCY)
+)
 
 # --- Configuración DB ---
 DB_CONFIG = {
@@ -26,55 +55,279 @@ DB_CONFIG = {
 }
 
 MAX_QUESTIONS = 15002  # Límite total de preguntas a procesar
+LOG_EVERY = 100        # Imprimir progreso cada N preguntas
+PAGE_SIZE = 1000       # Filas por viaje al recorrer las preguntas pendientes
+BACKUP_ITERSIZE = 10000 # Filas por viaje al exportar el backup
+MAX_ROUNDS = 5         # Vueltas completas por las keys antes de dejar una pregunta para después
+RPM_LIMIT = int(os.getenv("RPM_LIMIT", 20 * len(API_KEYS)))  # Peticiones por minuto a OpenRouter (todas las keys)
+SNAPSHOT_EVERY = 1000  # Respuestas nuevas entre snapshots consolidados de grok_answers.json
+DB_FLUSH_EVERY = 5000  # Respuestas acumuladas antes de escribirlas en questions.grok_answer (COPY + un UPDATE por lote)
+
+# --- Control de cuota por key (headers de OpenRouter) ---
+class RateState:
+    """Cuota restante de una API key según los headers X-RateLimit-* / Retry-After,
+    más un enfriamiento exponencial propio tras 429/5xx seguidos y las llamadas en vuelo"""
+    def __init__(self):
+        self.limit = None
+        self.remaining = None
+        self.reset_at = 0.0
+        self.fails = 0
+        self.cooldown_until = 0.0
+        self.in_flight = 0
+        self.last_used = 0.0
+
+    def update(self, headers):
+        try:
+            if "x-ratelimit-limit" in headers:
+                self.limit = int(headers["x-ratelimit-limit"])
+            if "x-ratelimit-remaining" in headers:
+                self.remaining = int(headers["x-ratelimit-remaining"])
+            if "x-ratelimit-reset" in headers:
+                self.reset_at = _to_epoch(float(headers["x-ratelimit-reset"]))
+            if "retry-after" in headers:
+                self.reset_at = max(self.reset_at, time.time() + float(headers["retry-after"]))
+        except ValueError:
+            pass  # header con formato inesperado: se ignora
+
+    def on_success(self):
+        self.fails = 0
+        self.cooldown_until = 0.0
+
+    def on_failure(self):
+        self.fails += 1
+        self.cooldown_until = time.time() + min(2 ** self.fails, 60)
+
+    def wait_time(self):
+        """Segundos que hay que dejar descansar la key antes de usarla"""
+        now = time.time()
+        cooldown = max(0.0, self.cooldown_until - now)
+        if self.reset_at <= now:
+            return cooldown
+        if self.remaining is None or self.limit is None or self.remaining < 0.1 * self.limit:
+            return max(cooldown, self.reset_at - now)
+        return cooldown
+
+def _to_epoch(value):
+    """X-RateLimit-Reset puede venir en ms epoch, s epoch o segundos relativos"""
+    if value > 1e12:
+        return value / 1000
+    if value > 1e9:
+        return value
+    return time.time() + value
+
+class AIMDLimiter:
+    """Concurrencia adaptativa: +1/limit por éxito, x beta ante 429/5xx (a lo más una vez por ventana).
+    Cada liberación despierta solo a tantos waiters como cupos libres haya (no a todos)"""
+    def __init__(self, max_limit, beta=0.5):
+        self.max_limit = max_limit
+        self.limit = float(max_limit)
+        self.beta = beta
+        self.inflight = 0
+        self._waiters = collections.deque()
+        self._woken = 0  # waiters despertados que todavía no retoman (cupo reservado)
+        self._last_decrease = float("-inf")  # monotonic de la última reducción del límite
+
+    async def __aenter__(self):
+        if not self._waiters and self.inflight + self._woken < int(self.limit):
+            self.inflight += 1
+            return
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.append(fut)
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # ya tenía cupo reservado: se lo pasa al siguiente
+                self._woken -= 1
+                self._wake()
+            else:
+                try:
+                    self._waiters.remove(fut)
+                except ValueError:
+                    pass
+            raise
+        self._woken -= 1
+        self.inflight += 1
+
+    async def __aexit__(self, *exc):
+        self.inflight -= 1
+        self._wake()
+
+    def _wake(self):
+        free = int(self.limit) - self.inflight - self._woken
+        while free > 0 and self._waiters:
+            fut = self._waiters.popleft()
+            if fut.done():
+                continue  # cancelado mientras esperaba
+            fut.set_result(None)
+            self._woken += 1
+            free -= 1
+
+    def on_success(self):
+        self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+        self._wake()  # si el límite subió un entero entra un waiter más
+
+    def on_throttle(self, sent_at):
+        # Las peticiones enviadas antes de la última reducción ya vieron el límite viejo:
+        # una ráfaga de 429 concurrentes cuenta como una sola señal, no colapsa el límite a 1
+        if sent_at < self._last_decrease:
+            return
+        self.limit = max(1.0, self.limit * self.beta)
+        self._last_decrease = time.monotonic()
+
+class SlidingWindow:
+    """Límite de peticiones por minuto (ventana deslizante de 60 s): solo espera cuando la ventana está llena"""
+    def __init__(self, rpm):
+        self.rpm = rpm
+        self.dq = collections.deque()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            while self.dq and self.dq[0] <= now - 60:
+                self.dq.popleft()
+            if len(self.dq) < self.rpm:
+                self.dq.append(now)
+                return
+            await asyncio.sleep(self.dq[0] + 60 - now)
+
+key_states = {k: RateState() for k in API_KEYS}
+limiter = AIMDLimiter(MAX_CONCURRENCY)
+rpm_window = SlidingWindow(RPM_LIMIT)
+
+# --- Payload y headers precalculados ---
+HEADERS_BY_KEY = {k: {"Authorization": f"Bearer {k}", "Content-Type": "application/json"} for k in API_KEYS}
+_PAYLOAD = {
+    "model": "x-ai/grok-4-fast:free",
+    "messages": [{"role": "user", "content": [{"type": "text", "text": ""}]}]
+}
+_CONTENT = _PAYLOAD["messages"][0]["content"]
+
+def build_body(question, image=None):
+    """Serializa el payload cambiando solo el texto (y la imagen) sobre el esqueleto fijo"""
+    _CONTENT[0]["text"] = question
+    if not image:
+        return orjson.dumps(_PAYLOAD)
+    _CONTENT.append({"type": "image_url", "image_url": {"url": image}})
+    try:
+        return orjson.dumps(_PAYLOAD)
+    finally:
+        _CONTENT.pop()
+
+# --- Respuesta de OpenRouter (msgspec decodifica y valida los bytes en una pasada, sin recorrer dicts) ---
+class ORMessage(msgspec.Struct):
+    content: str | list | None = None
+
+class ORChoice(msgspec.Struct):
+    message: ORMessage
+
+class ORResponse(msgspec.Struct):
+    choices: list[ORChoice] = []
+
+_decode_response = msgspec.json.Decoder(ORResponse).decode
 
 # --- Función para llamar a Grok ---
-def call_grok(question, image=None, wait_on_fail=10):
-    tried_keys = set()
-    while len(tried_keys) < len(API_KEYS):
-        key = next(api_keys_cycle)
-        if key in tried_keys:
-            continue
-        tried_keys.add(key)
-
-        content_list = [{"type": "text", "text": question}]
-        if image:
-            content_list.append({"type": "image_url", "image_url": {"url": image}})
-
-        payload = {
-            "model": "x-ai/grok-4-fast:free",
-            "messages": [{"role": "user", "content": content_list}]
-        }
+async def call_grok(question, image=None):
+    """Pide la respuesta a Grok rotando keys; tras MAX_ROUNDS vueltas fallidas devuelve None"""
+    body = build_body(question, image)  # se serializa una vez y se reutiliza en cada key/intento
+    for attempt in range(MAX_ROUNDS):
+        # El cupo del limiter se toma solo mientras se prueban las keys: las esperas de abajo
+        # (backoff / Retry-After) no cuentan como peticiones en vuelo
+        async with limiter:
+            content = await _try_all_keys(body)
+        if content is not None:
+            return content
+        if attempt == MAX_ROUNDS - 1:
+            break  # última vuelta: no tiene sentido esperar para luego rendirse
+
+        # Todas las keys fallaron o están sin cuota: esperar a la que se libere primero,
+        # o backoff exponencial con jitter si ninguna informó cuándo se libera
+        waits = [s.wait_time() for s in key_states.values()]
+        if all(w > 0 for w in waits):
+            wait = min(waits)
+        else:
+            wait = min(2 ** attempt + random.random(), 30)
+        print(f"❌ Todas las API keys fallaron (intento {attempt + 1}/{MAX_ROUNDS}). Esperando {wait:.1f}s...")
+        await asyncio.sleep(wait)
+
+    print(f"🚫 Sin respuesta tras {MAX_ROUNDS} intentos; la pregunta queda pendiente para la próxima sesión.")
+    return None
+
+def pick_key(candidates):
+    """Key que se libera antes; a igualdad, la con menos llamadas en vuelo y luego la usada hace más tiempo"""
+    return min(candidates, key=lambda k: (key_states[k].wait_time(), key_states[k].in_flight, key_states[k].last_used))
+
+async def _try_all_keys(body):
+    """Una vuelta por las keys disponibles (la mejor primero); devuelve el contenido o None si ninguna respondió"""
+    untried = set(API_KEYS)
+    while untried:
+        key = pick_key(untried)
+        untried.discard(key)
+
+        state = key_states[key]
+        if state.wait_time() > 0:
+            # Hasta la mejor key está en pausa: call_grok espera a que se libere
+            return None
 
+        state.in_flight += 1
+        state.last_used = time.monotonic()
         try:
-            response = requests.post(
-                "https://openrouter.ai/api/v1/chat/completions",
-                headers={"Authorization": f"Bearer {key}", "Content-Type": "application/json"},
-                data=json.dumps(payload),
-                timeout=30
+            await rpm_window.acquire()
+            sent_at = time.monotonic()
+            response = await http_client.post(
+                OPENROUTER_URL,
+                headers=HEADERS_BY_KEY[key],
+                content=body
             )
-            data = response.json()
-            if "choices" in data and data["choices"]:
-                content = data["choices"][0]["message"]["content"]
+            state.update(response.headers)
+            if response.status_code == 429 or response.status_code >= 500:
+                limiter.on_throttle(sent_at)
+                state.on_failure()
+                print(f"⚠️ Key {key[:8]} limitada (HTTP {response.status_code}). Rotando...")
+                continue
+            data = _decode_response(response.content)
+            if data.choices and data.choices[0].message.content is not None:
+                content = data.choices[0].message.content
+                limiter.on_success()
+                state.on_success()
                 if isinstance(content, list):
-                    return " ".join([c.get("text", "") for c in content])
+                    return " ".join([c.get("text", "") for c in content if isinstance(c, dict)])
                 return content
-        except requests.exceptions.RequestException as e:
+            # respuesta sin choices (p.ej. error de la API para esta pregunta): rotar key sin castigarla
+        except httpx.HTTPError as e:
             print(f"Error con key {key}: {e}. Rotando...")
-        except json.JSONDecodeError:
-            print(f"Key {key} devolvió respuesta no JSON. Rotando...")
+        except msgspec.DecodeError:
+            print(f"Key {key} devolvió respuesta no JSON o con otra forma. Rotando...")
+        finally:
+            state.in_flight -= 1
+        # Sin espera fija entre keys: cada key lleva su propia cuota y enfriamiento (RateState,
+        # que solo se activa ante 429/5xx); si fallan todas, call_grok espera lo que indiquen los headers o hace backoff
+    return None
 
-        print(f"⏱ Esperando {wait_on_fail}s antes de intentar otra key...")
-        time.sleep(wait_on_fail)
+# --- Función worker ---
+async def process_question(q, total, idx):
+    if idx % LOG_EVERY == 0:
+        print(f"Trabajando pregunta {idx}/{total}: {q['question_text'][:50]}...")
+    llm_answer = await call_grok(q["question_text"], q.get("image_url"))
+    return q, llm_answer
 
-    print(f"❌ Todas las API keys fallaron. Esperando {wait_on_fail*2}s antes de reintentar...")
-    time.sleep(wait_on_fail*2)
-    return call_grok(question, image, wait_on_fail)
+def question_key(question_text, image_url=None):
+    """Clave estable de deduplicación: texto normalizado (strip + lower) resumido con blake2b"""
+    normalized = question_text.strip().lower()
+    digest = hashlib.blake2b(normalized.encode("utf-8"), digest_size=16).hexdigest()
+    return f"{digest}:{image_url}" if image_url else digest
 
-# --- Función worker ---
-def process_question(q, total, idx):
-    print(f"Trabajando pregunta {idx}/{total}: {q['question_text'][:50]}...")
-    llm_answer = call_grok(q["question_text"], q.get("image_url"))
-    result = {
+# Timestamp ISO cacheado: se formatea una sola vez por segundo
+_last_ts = [0, ""]
+
+def now_iso():
+    t = int(time.time())
+    if t != _last_ts[0]:
+        _last_ts[:] = [t, datetime.fromtimestamp(t).isoformat()]
+    return _last_ts[1]
+
+def build_result(q, llm_answer):
+    return {
         "question_text": q["question_text"],
         "human_answer": q.get("human_answer", ""),
         "llm_answer": llm_answer,
@@ -82,41 +335,210 @@ def process_question(q, total, idx):
         "quality_score": None,
         "completeness_score": None,
         "overall_score": None,
-        "created_at": datetime.now().isoformat(),
+        "created_at": now_iso(),
         "evaluated_at": None
     }
-    return q["id"], result
+
+# --- Lectura de preguntas ---
+def fetch_pending_questions(conn, processed_ids, limit):
+    """Recorre con un cursor del lado del servidor las preguntas sin respuesta de Grok en la DB
+    (grok_answer, índice parcial idx_questions_missing_grok) hasta juntar `limit` que tampoco estén
+    en grok_answers, que sigue siendo la fuente de verdad de lo ya respondido.
+    Con WORKER_COUNT > 1 cada worker toma solo los IDs con id % WORKER_COUNT = WORKER_ID"""
+    pending = []
+    # Cursor con nombre: Postgres filtra y entrega PAGE_SIZE filas por viaje, sin cargar la tabla en memoria
+    with conn.cursor(name="pending_cur") as cur:
+        cur.itersize = PAGE_SIZE
+        cur.execute(
+            "SELECT id, question_text, human_answer FROM questions "
+            "WHERE grok_answer IS NULL AND id %% %s = %s ORDER BY id ASC",
+            (WORKER_COUNT, WORKER_ID)
+        )
+        for r in cur:
+            if str(r[0]) in processed_ids:
+                continue
+            pending.append({
+                "id": r[0],
+                "question_text": r[1],
+                "human_answer": r[2] or "",
+                "image_url": None
+            })
+            if len(pending) >= limit:
+                break
+    return pending
+
+def export_questions_backup(conn, path):
+    """Guarda todas las preguntas de la DB en un JSONL de respaldo (una fila por línea)"""
+    # Cursor con nombre (del lado del servidor): trae BACKUP_ITERSIZE filas por viaje
+    with conn.cursor(name="backup_cur") as cur, open(path, "wb") as f:
+        cur.itersize = BACKUP_ITERSIZE
+        cur.execute("SELECT id, question_text, human_answer FROM questions ORDER BY id ASC")
+        for r in cur:
+            f.write(orjson.dumps(
+                {"id": r[0], "question_text": r[1], "human_answer": r[2] or "", "image_url": None}
+            ) + b"\n")
+
+# Staging temporal: COPY carga el lote y un solo UPDATE ... FROM lo pasa a questions
+STAGE_DDL = "CREATE TEMP TABLE grok_answers_staging (id INTEGER, grok_answer TEXT) ON COMMIT DROP"
+
+def flush_answers_to_db(rows):
+    """Escribe un lote de (id, respuesta) en questions.grok_answer: COPY al staging y un UPDATE ... FROM.
+    No toca llm_answer, que es la respuesta del modelo del evaluador /evaluate"""
+    # COPY en CSV: el módulo csv se encarga de comillas y saltos de línea; QUOTE_NONNUMERIC
+    # deja las respuestas vacías como '' y no como NULL
+    buf = io.StringIO()
+    csv.writer(buf, quoting=csv.QUOTE_NONNUMERIC, lineterminator="\n").writerows(rows)
+    buf.seek(0)
+
+    conn = None
+    try:
+        conn = psycopg2.connect(**DB_CONFIG)
+        with conn, conn.cursor() as cur:
+            cur.execute(STAGE_DDL)
+            cur.copy_expert("COPY grok_answers_staging (id, grok_answer) FROM STDIN WITH (FORMAT csv)", buf)
+            cur.execute("""
+                UPDATE questions AS q SET grok_answer = s.grok_answer
+                FROM grok_answers_staging AS s WHERE q.id = s.id
+            """)
+        print(f"🗄️ {len(rows)} respuestas escritas en la DB")
+    except psycopg2.Error as e:
+        # No se corta la sesión: las respuestas siguen quedando en grok_answers.json
+        print(f"⚠️ No se pudo escribir el lote en la DB: {e}")
+    finally:
+        if conn:
+            conn.close()
+
+# --- Persistencia: log JSONL (append por respuesta) + snapshot .json para los demás servicios ---
+def load_answers(json_path, jsonl_path):
+    """Snapshot grok_answers.json + las líneas del log que aún no están consolidadas"""
+    answers = {}
+    if os.path.exists(json_path):
+        with open(json_path, "rb") as f:
+            answers = orjson.loads(f.read())
+    if os.path.exists(jsonl_path):
+        with open(jsonl_path, "rb") as f:
+            for line in f:
+                try:
+                    rec = orjson.loads(line)
+                except orjson.JSONDecodeError:
+                    continue  # última línea cortada por una caída a mitad de escritura
+                answers[str(rec.pop("id"))] = rec
+    return answers
+
+def answer_paths(base_path, worker_id=None):
+    """(snapshot .json, log .jsonl): los consolidados o, con worker_id, los del shard de ese worker"""
+    suffix = "" if worker_id is None else f".w{worker_id}"
+    return (os.path.join(base_path, f"grok_answers{suffix}.json"),
+            os.path.join(base_path, f"grok_answers{suffix}.jsonl"))
+
+def merge_worker_shards(base_path):
+    """Junta los shards grok_answers.w<N>.json/.jsonl en el grok_answers.json consolidado.
+    Correr solo cuando todos los workers terminaron: los shards se borran al final"""
+    merged_json, merged_log = answer_paths(base_path)
+    answers = load_answers(merged_json, merged_log)
+    # Un shard puede tener solo el log (worker caído antes de su primer snapshot)
+    shards = sorted({p[:-1] if p.endswith(".jsonl") else p
+                     for p in glob.glob(os.path.join(base_path, "grok_answers.w*.json*"))
+                     if p.endswith((".json", ".jsonl"))})
+    for shard_json in shards:
+        answers.update(load_answers(shard_json, shard_json + "l"))
+    write_snapshot(answers, merged_json)
+    open(merged_log, "wb").close()
+    for shard_json in shards:
+        for path in (shard_json, shard_json + "l"):
+            if os.path.exists(path):
+                os.remove(path)
+    print(f"🧩 {len(shards)} shards consolidados en {merged_json} ({len(answers)} respuestas)")
+
+def worker_quota(answers):
+    """Cupo de MAX_QUESTIONS que le toca a este worker menos lo ya respondido en su partición de IDs"""
+    share = MAX_QUESTIONS // WORKER_COUNT + (1 if WORKER_ID < MAX_QUESTIONS % WORKER_COUNT else 0)
+    done = sum(1 for k in answers if int(k) % WORKER_COUNT == WORKER_ID)
+    return share - done
+
+def write_snapshot(answers, json_path):
+    """Reescribe grok_answers.json completo (sin indent) vía archivo temporal + rename atómico"""
+    tmp_path = json_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(orjson.dumps(answers))
+    os.replace(tmp_path, json_path)
+
+# --- Fan-out asíncrono hacia Grok ---
+async def answer_questions(unique_questions, groups, grok_answers, output_json_path, answers_log_path):
+    """Lanza todas las preguntas en paralelo (concurrencia adaptativa, tope MAX_CONCURRENCY) y guarda a medida que terminan"""
+    processed = 0
+    unsaved = 0
+    db_rows = []
+    total = len(unique_questions)
+    log = open(answers_log_path, "ab")
+
+    try:
+        tasks = [process_question(q, total, i+1) for i, q in enumerate(unique_questions)]
+        for next_done in asyncio.as_completed(tasks):
+            q, llm_answer = await next_done
+            if llm_answer is None:
+                continue  # no se guarda: se reintenta en la próxima sesión
+            for dup in groups[q["text_key"]]:
+                result = build_result(dup, llm_answer)
+                grok_answers[str(dup["id"])] = result
+                log.write(orjson.dumps({"id": dup["id"], **result}) + b"\n")
+                db_rows.append((dup["id"], llm_answer))
+                processed += 1
+                unsaved += 1
+            log.flush()
+            if unsaved >= SNAPSHOT_EVERY:
+                write_snapshot(grok_answers, output_json_path)
+                unsaved = 0
+                print(f"💾 Guardadas {processed} preguntas nuevas hasta ahora...")
+            if len(db_rows) >= DB_FLUSH_EVERY:
+                await asyncio.to_thread(flush_answers_to_db, db_rows)
+                db_rows = []
+    finally:
+        log.close()
+        await http_client.aclose()
+        if db_rows:
+            await asyncio.to_thread(flush_answers_to_db, db_rows)
+    return processed
 
 # --- Función principal ---
 def main():
     base_path = os.path.dirname(os.path.abspath(__file__))
 
     # Rutas
-    backup_json_path = os.path.join(base_path, "questions_backup.json")
-    output_json_path = os.path.join(base_path, "grok_answers.json")
+    backup_json_path = os.path.join(base_path, "questions_backup.jsonl")
+    # Con varios workers cada uno escribe solo en su shard (grok_answers.w<ID>.json/.jsonl);
+    # el consolidado se lee pero no se toca hasta `python app.py merge`
+    if WORKER_COUNT > 1:
+        output_json_path, answers_log_path = answer_paths(base_path, WORKER_ID)
+    else:
+        output_json_path, answers_log_path = answer_paths(base_path)
 
     # --- Cargar respuestas ya procesadas ---
-    if os.path.exists(output_json_path):
-        with open(output_json_path, "r", encoding="utf-8") as f:
-            grok_answers = json.load(f)
-        print(f"🔄 Continuando desde {len(grok_answers)} preguntas ya procesadas...")
-    else:
-        grok_answers = {}
+    grok_answers = load_answers(output_json_path, answers_log_path)
+    known_answers = grok_answers
+    if WORKER_COUNT > 1:
+        known_answers = {**load_answers(*answer_paths(base_path)), **grok_answers}
+    if known_answers:
+        print(f"🔄 Continuando desde {len(known_answers)} preguntas ya procesadas...")
+
+    remaining_slots = worker_quota(known_answers)
 
     # --- Extraer preguntas de la DB ---
-    questions = []
+    conn = None
     try:
         conn = psycopg2.connect(**DB_CONFIG)
-        with conn.cursor() as cur:
-            cur.execute("SELECT id, question_text, human_answer FROM questions ORDER BY id ASC")
-            rows = cur.fetchall()
-            for r in rows:
-                questions.append({
-                    "id": r[0],
-                    "question_text": r[1],
-                    "human_answer": r[2] or "",
-                    "image_url": None
-                })
+
+        # --- Guardar backup de preguntas si no existe (solo el worker 0: el archivo es compartido) ---
+        if WORKER_ID == 0 and not os.path.exists(backup_json_path):
+            export_questions_backup(conn, backup_json_path)
+            print(f"💾 Backup de preguntas guardado en {backup_json_path}")
+
+        if remaining_slots <= 0:
+            print(f"✅ Ya se alcanzaron {MAX_QUESTIONS} preguntas procesadas (cupo del worker {WORKER_ID}/{WORKER_COUNT}).")
+            return
+
+        # --- Filtrar preguntas nuevas y limitar hasta MAX_QUESTIONS ---
+        questions_to_process = fetch_pending_questions(conn, known_answers, remaining_slots)
     except psycopg2.OperationalError as e:
         print(f"❌ No se pudo conectar a la DB: {e}")
         return
@@ -124,43 +546,30 @@ def main():
         if conn:
             conn.close()
 
-    # --- Guardar backup de preguntas si no existe ---
-    if not os.path.exists(backup_json_path):
-        with open(backup_json_path, "w", encoding="utf-8") as f:
-            json.dump(questions, f, ensure_ascii=False, indent=2)
-        print(f"💾 Backup de preguntas guardado en {backup_json_path}")
-
-    # --- Filtrar preguntas nuevas y limitar hasta MAX_QUESTIONS ---
-    questions_to_process = [q for q in questions if str(q["id"]) not in grok_answers]
-    already_processed = len(grok_answers)
-    remaining_slots = MAX_QUESTIONS - already_processed
-    if remaining_slots <= 0:
-        print(f"✅ Ya se alcanzaron {MAX_QUESTIONS} preguntas procesadas.")
-        return
+    # --- Agrupar preguntas con texto idéntico: una sola llamada a Grok por texto ---
+    # (la clave normalizada se calcula una sola vez por pregunta y queda guardada en ella)
+    groups = {}
+    for q in questions_to_process:
+        q["text_key"] = question_key(q["question_text"], q.get("image_url"))
+        groups.setdefault(q["text_key"], []).append(q)
+    unique_questions = [qs[0] for qs in groups.values()]
 
-    questions_to_process = questions_to_process[:remaining_slots]
-    total = len(questions_to_process)
-    print(f"📌 Total de preguntas nuevas a procesar en esta sesión: {total}")
+    total = len(unique_questions)
+    print(f"📌 Total de preguntas nuevas a procesar en esta sesión: {len(questions_to_process)} ({total} textos únicos)")
 
-    save_every = 1
-    processed = 0
+    processed = asyncio.run(
+        answer_questions(unique_questions, groups, grok_answers, output_json_path, answers_log_path)
+    )
 
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        futures = {executor.submit(process_question, q, total, i+1): i for i, q in enumerate(questions_to_process)}
-        for future in as_completed(futures):
-            qid, result = future.result()
-            with lock:
-                grok_answers[str(qid)] = result
-                processed += 1
-                if processed % save_every == 0:
-                    with open(output_json_path, "w", encoding="utf-8") as f:
-                        json.dump(grok_answers, f, ensure_ascii=False, indent=2)
-                    print(f"💾 Guardadas {processed} preguntas nuevas hasta ahora...")
-
-    # Guardar lo que quede al final
-    with open(output_json_path, "w", encoding="utf-8") as f:
-        json.dump(grok_answers, f, ensure_ascii=False, indent=2)
+    # Snapshot final: todo queda consolidado en el .json y el log se vacía
+    write_snapshot(grok_answers, output_json_path)
+    open(answers_log_path, "wb").close()
     print(f"✅ Grok answers guardadas en {output_json_path} (total procesadas en esta sesión: {processed})")
+    if WORKER_COUNT > 1:
+        print("🧩 Cuando terminen todos los workers, consolidar con: python app.py merge")
 
 if __name__ == "__main__":
-    main()
+    if sys.argv[1:] == ["merge"]:
+        merge_worker_shards(os.path.dirname(os.path.abspath(__file__)))
+    else:
+        main()
@@ -1,13 +1,23 @@
 # archivo: evaluate_glm_jsonl.py
 import os
-import json
 import time
 import re
+import mmap
+import orjson
+import ijson
+import asyncio
+import collections
+import hashlib
+import sqlite3
 from itertools import cycle
-from datetime import datetime
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from threading import Lock
-from openai import OpenAI
+from datetime import datetime, timezone
+from openai import AsyncOpenAI
+
+try:
+    import uvloop  # loop en C (libuv): más rápido que el de asyncio para el fan-out de llamadas
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+except ImportError:
+    pass
 
 # --- Configuración ---
 API_KEYS = [k.strip() for k in os.getenv("OPENROUTER_API_KEY", "").split(",") if k.strip()]
@@ -15,32 +25,88 @@ if not API_KEYS:
     raise ValueError("No se encontraron API keys en OPENROUTER_API_KEY")
 api_keys_cycle = cycle(API_KEYS)
 
+# Un cliente OpenAI asíncrono por key, creado una sola vez: reutiliza su pool de conexiones keep-alive
+CLIENTS = {k: AsyncOpenAI(base_url="https://openrouter.ai/api/v1", api_key=k) for k in API_KEYS}
+
 DATA_PATH = "/data/grok_answers.json"            # input: JSON con las preguntas y respuestas
 OUTPUT_PATH = "/data/grok_answers_evaluated.jsonl"  # salida: JSONL
+EVAL_CACHE_PATH = "/data/eval_cache.db"             # caché de evaluaciones por hash del par
+CACHE_COMMIT_EVERY = 100                            # commit del caché cada 100 inserciones
 MAX_ENTRIES = 10001  # límite total
-SAVE_EVERY = 40      # guardar cada 40 resultados
-
-lock = Lock()
+SAVE_EVERY = 40      # vaciar a disco cada 40 resultados
+MAX_CONCURRENCY = int(os.getenv("MAX_CONCURRENCY", 50))  # evaluaciones en vuelo a la vez
+EVAL_BATCH_SIZE = int(os.getenv("EVAL_BATCH_SIZE", 5))   # pares por prompt a GLM
+EVAL_BATCH_WAIT = 0.05   # segundos máximos esperando completar un lote
+EVAL_BATCH_CHARS = 6000  # ~2048 tokens de entrada por prompt
+PROCESSED_KEY_RE = re.compile(rb'^\{"key":\s*"([^"]+)"', re.M)
+RPM_LIMIT = int(os.getenv("RPM_LIMIT", 20 * len(API_KEYS)))  # peticiones por minuto a OpenRouter (todas las keys)
 
 # --- Helper para limpiar JSON ---
+def _find_json_span(text: str):
+    """Devuelve (inicio, fin) del primer objeto {...} balanceado, ignorando llaves dentro de strings"""
+    depth = 0
+    start = -1
+    in_str = False
+    esc = False
+    for i, c in enumerate(text):
+        if in_str:
+            if esc:
+                esc = False
+            elif c == "\\":
+                esc = True
+            elif c == '"':
+                in_str = False
+        elif c == '"':
+            if depth:
+                in_str = True
+        elif c == "{":
+            if depth == 0:
+                start = i
+            depth += 1
+        elif c == "}" and depth:
+            depth -= 1
+            if depth == 0:
+                return start, i + 1
+    return None
+
 def safe_load_json_from_text(text: str):
     text = text.strip()
-    if text.startswith("{") or text.startswith("["):
+    if text.startswith(("{", "[")):
         try:
-            return json.loads(text)
+            return orjson.loads(text)
         except Exception:
             pass
-    match = re.search(r"(\{(?:[^{}]|(?R))*\})", text, flags=re.DOTALL)
-    if match:
+    span = _find_json_span(text)
+    if span:
         try:
-            return json.loads(match.group(1))
+            return orjson.loads(text[span[0]:span[1]])
         except Exception:
             pass
     return None
 
 
+# --- Ritmo de peticiones ---
+class SlidingWindow:
+    """Ventana de 60 s con los instantes de las últimas llamadas a GLM; acquire() espera solo si ya hay RPM_LIMIT"""
+    def __init__(self, rpm):
+        self.rpm = rpm
+        self.dq = collections.deque()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            while self.dq and self.dq[0] <= now - 60:
+                self.dq.popleft()
+            if len(self.dq) < self.rpm:
+                self.dq.append(now)
+                return
+            await asyncio.sleep(self.dq[0] + 60 - now)
+
+rpm_window = SlidingWindow(RPM_LIMIT)
+
+
 # --- Llamada al modelo GLM-4.5 con rotación de keys ---
-def call_glm(prompt, wait_on_fail=10):
+async def call_glm(prompt, wait_on_fail=10):
     tried_keys = set()
     while len(tried_keys) < len(API_KEYS):
         key = next(api_keys_cycle)
@@ -49,10 +115,11 @@ def call_glm(prompt, wait_on_fail=10):
         tried_keys.add(key)
 
         try:
-            client = OpenAI(base_url="https://openrouter.ai/api/v1", api_key=key)
+            client = CLIENTS[key]
             print(f"⏳ Llamando a GLM-4.5 con key {key[:8]}...")
 
-            completion = client.chat.completions.create(
+            await rpm_window.acquire()
+            completion = await client.chat.completions.create(
                 model="z-ai/glm-4.5-air:free",
                 messages=[{"role": "user", "content": prompt}],
                 extra_headers={
@@ -70,17 +137,35 @@ def call_glm(prompt, wait_on_fail=10):
 
         except Exception as e:
             print(f"❌ Error con key {key[:8]}: {e}. Rotando...")
-            time.sleep(wait_on_fail)
+            await asyncio.sleep(wait_on_fail)
 
     raise RuntimeError("Todas las API keys fallaron.")
 
 
+# --- Caché de evaluaciones (pares humana/LLM idénticos) ---
+_eval_cache = None  # sqlite3.Connection, se abre en el primer uso
+_inflight = {}      # hash -> asyncio.Task de la evaluación en curso
+_cache_writes = 0   # inserciones desde el arranque; se hace commit cada CACHE_COMMIT_EVERY
+
+
+def get_eval_cache():
+    global _eval_cache
+    if _eval_cache is None:
+        _eval_cache = sqlite3.connect(EVAL_CACHE_PATH)
+        _eval_cache.execute("CREATE TABLE IF NOT EXISTS c(k TEXT PRIMARY KEY, v TEXT)")
+    return _eval_cache
+
+
+def eval_cache_key(human_answer, llm_answer):
+    return hashlib.blake2b(f"{human_answer}\x00{llm_answer}".encode("utf-8")).hexdigest()
+
+
 # --- Evaluación de una respuesta ---
-def evaluate_response(human_answer, llm_answer):
-    prompt = f"""
+# Plantillas fijas a nivel de módulo: por llamada solo se rellenan los campos con format_map
+_EVAL_TEMPLATE = """
 Evalúa estas respuestas:
-Humana: {human_answer}
-LLM: {llm_answer}
+Humana: {h}
+LLM: {l}
 
 Responde en JSON con exactamente estas claves:
 {{
@@ -90,25 +175,165 @@ Responde en JSON con exactamente estas claves:
 }}
 Devuelve SOLO JSON (sin texto adicional).
 """
+
+_PAIR_TEMPLATE = "### Par {i}\nHumana: {h}\nLLM: {l}\n"
+
+_BATCH_TEMPLATE = """
+Evalúa estos {n} pares de respuestas:
+{pairs}
+Responde con un arreglo JSON de exactamente {n} objetos, uno por par y en el mismo orden,
+cada uno con exactamente estas claves:
+{{"similarity_score": 0.0, "quality_score": 0.0, "completeness_score": 0.0}}
+Devuelve SOLO el arreglo JSON (sin texto adicional).
+"""
+
+def _to_scores(parsed):
+    def to_float(v):
+        try:
+            return float(v)
+        except:
+            return 0.0
+    return {
+        "similarity_score": to_float(parsed.get("similarity_score", 0.0)),
+        "quality_score": to_float(parsed.get("quality_score", 0.0)),
+        "completeness_score": to_float(parsed.get("completeness_score", 0.0))
+    }
+
+
+async def _evaluate_single(human_answer, llm_answer):
+    """Llama a GLM con un solo par; devuelve los puntajes o None si no se pudo evaluar"""
+    prompt = _EVAL_TEMPLATE.format_map({"h": human_answer, "l": llm_answer})
     try:
-        raw = call_glm(prompt)
+        raw = await call_glm(prompt)
         parsed = safe_load_json_from_text(raw)
-        if parsed is None:
+        if not isinstance(parsed, dict):
             print("⚠️ No se pudo extraer JSON. Texto devuelto:", raw[:200])
-            return {"similarity_score": 0.0, "quality_score": 0.0, "completeness_score": 0.0}
-        def to_float(v):
-            try:
-                return float(v)
-            except:
-                return 0.0
-        return {
-            "similarity_score": to_float(parsed.get("similarity_score", 0.0)),
-            "quality_score": to_float(parsed.get("quality_score", 0.0)),
-            "completeness_score": to_float(parsed.get("completeness_score", 0.0))
-        }
+            return None
+        return _to_scores(parsed)
     except Exception as e:
         print(f"❌ Error en evaluate_response: {e}")
-        return {"similarity_score": 0.0, "quality_score": 0.0, "completeness_score": 0.0}
+        return None
+
+
+async def _evaluate_batch(batch):
+    """Evalúa varios pares en un solo prompt (respuesta: arreglo JSON en el mismo orden).
+    Los pares que no vengan bien en el arreglo se reintentan uno a uno."""
+    results = [None] * len(batch)
+    try:
+        if len(batch) > 1:
+            pairs = "\n".join(
+                _PAIR_TEMPLATE.format_map({"i": i + 1, "h": h, "l": l}) for i, (h, l, _) in enumerate(batch)
+            )
+            prompt = _BATCH_TEMPLATE.format_map({"n": len(batch), "pairs": pairs})
+            try:
+                raw = await call_glm(prompt)
+                parsed = safe_load_json_from_text(raw)
+                if not isinstance(parsed, list) and "[" in raw:
+                    parsed = safe_load_json_from_text(raw[raw.find("["):raw.rfind("]") + 1])
+                if isinstance(parsed, list):
+                    for i, item in enumerate(parsed[:len(batch)]):
+                        if isinstance(item, dict):
+                            results[i] = _to_scores(item)
+                else:
+                    print("⚠️ No se pudo extraer el arreglo JSON del lote. Evaluando uno a uno...")
+            except Exception as e:
+                print(f"❌ Error evaluando lote: {e}. Evaluando uno a uno...")
+
+        missing = [i for i, r in enumerate(results) if r is None]
+        if missing:
+            singles = await asyncio.gather(*(_evaluate_single(batch[i][0], batch[i][1]) for i in missing))
+            for i, r in zip(missing, singles):
+                results[i] = r
+    except Exception as e:
+        print(f"❌ Error inesperado evaluando lote: {e}")
+    finally:
+        # Toda future del lote queda resuelta pase lo que pase (None = no se pudo evaluar);
+        # si no, los workers que la esperan quedarían colgados para siempre
+        for (_, _, fut), r in zip(batch, results):
+            if not fut.done():
+                fut.set_result(r)
+
+
+class EvalBatcher:
+    """Junta hasta EVAL_BATCH_SIZE pares (o lo que llegue en EVAL_BATCH_WAIT s) en una sola llamada a GLM"""
+    def __init__(self):
+        self.pending = []  # [(humana, llm, future)]
+        self.chars = 0
+        self._timer = None
+        self._tasks = set()  # referencias fuertes: asyncio solo guarda referencias débiles a las tasks
+
+    def submit(self, human_answer, llm_answer):
+        loop = asyncio.get_running_loop()
+        size = len(human_answer) + len(llm_answer)
+        # Tope aproximado de tamaño del prompt (~EVAL_BATCH_CHARS caracteres)
+        if self.pending and self.chars + size > EVAL_BATCH_CHARS:
+            self.flush()
+        fut = loop.create_future()
+        self.pending.append((human_answer, llm_answer, fut))
+        self.chars += size
+        if len(self.pending) >= EVAL_BATCH_SIZE:
+            self.flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(EVAL_BATCH_WAIT, self.flush)
+        return fut
+
+    def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self.pending:
+            return
+        batch, self.pending, self.chars = self.pending, [], 0
+        task = asyncio.ensure_future(_evaluate_batch(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+
+_batcher = None
+
+
+async def _evaluate_uncached(human_answer, llm_answer):
+    """Encola el par en el lote en curso; devuelve los puntajes o None si no se pudo evaluar"""
+    global _batcher
+    if _batcher is None:
+        _batcher = EvalBatcher()
+    return await _batcher.submit(human_answer, llm_answer)
+
+
+async def evaluate_response(human_answer, llm_answer):
+    """Devuelve los puntajes del par o None si no se pudo evaluar (no se cachea el fallo)"""
+    k = eval_cache_key(human_answer, llm_answer)
+    cache = get_eval_cache()
+    row = cache.execute("SELECT v FROM c WHERE k=?", (k,)).fetchone()
+    if row:
+        return orjson.loads(row[0])
+
+    # Si el mismo par ya se está evaluando, esperar ese resultado en vez de llamar de nuevo
+    task = _inflight.get(k)
+    if task is None:
+        task = asyncio.ensure_future(_evaluate_uncached(human_answer, llm_answer))
+        _inflight[k] = task
+        task.add_done_callback(lambda _: _inflight.pop(k, None))
+    scores = await task
+    if scores is None:
+        return None
+
+    global _cache_writes
+    cache.execute("INSERT OR IGNORE INTO c(k, v) VALUES (?, ?)", (k, orjson.dumps(scores).decode()))
+    _cache_writes += 1
+    if _cache_writes % CACHE_COMMIT_EVERY == 0:
+        cache.commit()
+    return dict(scores)
+
+
+# Timestamp ISO cacheado: se formatea una sola vez por segundo
+_last_ts = [0, ""]
+
+def now_iso():
+    t = int(time.time())
+    if t != _last_ts[0]:
+        _last_ts[:] = [t, datetime.fromtimestamp(t, timezone.utc).replace(tzinfo=None).isoformat()]
+    return _last_ts[1]
 
 
 def calculate_overall(sim, qual, comp):
@@ -116,46 +341,109 @@ def calculate_overall(sim, qual, comp):
 
 
 # --- Procesar una sola pregunta ---
-def process_question(key, entry, processed_keys):
+async def process_question(key, entry, processed_keys):
     if key in processed_keys:
         return None
 
     print(f"🧠 Evaluando pregunta {key}...")
-    scores = evaluate_response(entry.get("human_answer", ""), entry.get("llm_answer", ""))
+    scores = await evaluate_response(entry.get("human_answer", ""), entry.get("llm_answer", ""))
+    if scores is None:
+        # No se escribe ni se marca como procesada: se reintenta en la próxima ejecución
+        print(f"⚠️ No se pudo evaluar {key}, se reintentará en la próxima ejecución")
+        return None
     overall = calculate_overall(scores["similarity_score"], scores["quality_score"], scores["completeness_score"])
 
     entry["similarity_score"] = scores["similarity_score"]
     entry["quality_score"] = scores["quality_score"]
     entry["completeness_score"] = scores["completeness_score"]
     entry["overall_score"] = overall
-    entry["evaluated_at"] = datetime.utcnow().isoformat()
+    entry["evaluated_at"] = now_iso()
 
     return (key, entry)
 
 
+# --- Evaluación concurrente (productor / consumidores) ---
+async def produce(queue, processed_keys, limit):
+    """Lee DATA_PATH en streaming y encola hasta `limit` entradas pendientes"""
+    queued = 0
+    with open(DATA_PATH, "rb") as f:
+        for k, v in ijson.kvitems(f, "", use_float=True):
+            if queued >= limit:
+                break
+            if k in processed_keys:
+                continue
+            await queue.put((k, v))
+            queued += 1
+    for _ in range(MAX_CONCURRENCY):
+        await queue.put(None)  # una señal de término por worker
+
+
+async def evaluate_all(processed_keys, current_count):
+    """Evalúa las entradas pendientes con MAX_CONCURRENCY workers alimentados por una cola acotada;
+    un único writer recibe los resultados y es el único que toca el archivo de salida"""
+    queue = asyncio.Queue(maxsize=200)
+    result_q = asyncio.Queue()
+
+    async def worker():
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            res = await process_question(item[0], item[1], processed_keys)
+            if res is not None:
+                await result_q.put(res)
+
+    async def writer():
+        nonlocal current_count
+        with open(OUTPUT_PATH, "ab", buffering=1024 * 1024) as out_f:
+            while True:
+                res = await result_q.get()
+                if res is None:
+                    break
+                key, entry = res
+                out_f.write(orjson.dumps({"key": key, "entry": entry}) + b"\n")
+                processed_keys.add(key)
+                current_count += 1
+
+                print(f"✅ Pregunta {key} evaluada. Total={current_count}")
+
+                # Vaciar el buffer del archivo cada SAVE_EVERY
+                if current_count % SAVE_EVERY == 0:
+                    out_f.flush()
+                    print(f"💾 Guardadas {current_count} entradas al JSONL.")
+
+            out_f.flush()
+            os.fsync(out_f.fileno())
+
+    writer_task = asyncio.ensure_future(writer())
+    try:
+        await asyncio.gather(
+            produce(queue, processed_keys, MAX_ENTRIES - current_count),
+            *(worker() for _ in range(MAX_CONCURRENCY))
+        )
+    finally:
+        await result_q.put(None)  # señal de término para el writer
+        await writer_task
+        if _eval_cache is not None:
+            _eval_cache.commit()
+
+
 # --- Main ---
 def main():
     if not os.path.exists(DATA_PATH):
         print(f"❌ No se encontró el archivo de entrada: {DATA_PATH}")
         return
 
-    with open(DATA_PATH, "r", encoding="utf-8") as f:
-        data = json.load(f)
-
     # Leer progreso previo
     processed_keys = set()
     current_count = 0
-    if os.path.exists(OUTPUT_PATH):
+    if os.path.exists(OUTPUT_PATH) and os.path.getsize(OUTPUT_PATH) > 0:
         try:
-            with open(OUTPUT_PATH, "r", encoding="utf-8") as f:
-                for line in f:
-                    if not line.strip():
-                        continue
-                    obj = json.loads(line)
-                    k = obj.get("key")
-                    if k:
-                        processed_keys.add(k)
-                        current_count += 1
+            # Escaneo lineal de bytes (sin parsear el JSON de cada línea): cada línea empieza con {"key":"..."
+            with open(OUTPUT_PATH, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for m in PROCESSED_KEY_RE.finditer(mm):
+                    processed_keys.add(m.group(1).decode("utf-8"))
+                    current_count += 1
             print(f"🔄 Reanudando desde {len(processed_keys)} evaluaciones previas.")
         except Exception as e:
             print("⚠️ Error leyendo el JSONL previo, continuando desde cero:", e)
@@ -164,54 +452,8 @@ def main():
         print(f"✅ Se alcanzó el límite máximo de {MAX_ENTRIES} evaluaciones.")
         return
 
-    max_workers = 5
-    buffer = []
-    save_every = SAVE_EVERY
-
     try:
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            futures = {}
-            for k, v in data.items():
-                if k in processed_keys:
-                    continue
-                if current_count >= MAX_ENTRIES:
-                    print(f"⚠️ Se alcanzó el límite de {MAX_ENTRIES}. Deteniendo proceso.")
-                    break
-                futures[executor.submit(process_question, k, v, processed_keys)] = k
-
-            with open(OUTPUT_PATH, "a", encoding="utf-8") as out_f:
-                for fut in as_completed(futures):
-                    res = fut.result()
-                    if res is None:
-                        continue
-                    key, entry = res
-                    line_obj = {"key": key, "entry": entry}
-                    buffer.append(line_obj)
-                    processed_keys.add(key)
-                    current_count += 1
-
-                    print(f"✅ Pregunta {key} evaluada. Total={current_count}")
-
-                    # Guardar cada SAVE_EVERY
-                    if len(buffer) >= save_every:
-                        for item in buffer:
-                            out_f.write(json.dumps(item, ensure_ascii=False) + "\n")
-                        out_f.flush()
-                        buffer.clear()
-                        print(f"💾 Guardadas {save_every} entradas al JSONL.")
-
-                    if current_count >= MAX_ENTRIES:
-                        print(f"⚠️ Se alcanzó el límite de {MAX_ENTRIES}. Finalizando ejecución.")
-                        break
-
-        # Guardar las últimas si hay
-        if buffer:
-            with open(OUTPUT_PATH, "a", encoding="utf-8") as out_f:
-                for item in buffer:
-                    out_f.write(json.dumps(item, ensure_ascii=False) + "\n")
-                out_f.flush()
-            print(f"💾 Guardadas las últimas {len(buffer)} entradas al JSONL.")
-
+        asyncio.run(evaluate_all(processed_keys, current_count))
     except KeyboardInterrupt:
         print("✋ Proceso interrumpido manualmente.")
     except Exception as e:
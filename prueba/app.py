@@ -1,25 +1,54 @@
 import os
+import re
+import asyncio
+import atexit
 import logging
-import json
-import threading
+import queue
+import orjson
+import msgspec
+from contextlib import asynccontextmanager
+from logging.handlers import QueueHandler, QueueListener
 from datetime import datetime
+from typing import List
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
-import psycopg2
-from openai import OpenAI
+import asyncpg
+from redis.exceptions import RedisError
+import httpx
 from confluent_kafka import Consumer, Producer
 from zoneinfo import ZoneInfo
+import llm_cache
 
 # --- Helper para datetime chileno ---
 def get_chile_time():
     return datetime.now(ZoneInfo("America/Santiago"))
 
 # --- Logging ---
-logging.basicConfig(level=logging.INFO)
+# Los handlers solo encolan el registro; el formateo y la escritura ocurren en el thread del listener
+_log_queue = queue.SimpleQueue()
+_log_stream = logging.StreamHandler()
+_log_stream.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+_log_listener = QueueListener(_log_queue, _log_stream)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+logging.basicConfig(level=logging.INFO, handlers=[QueueHandler(_log_queue)])
 logger = logging.getLogger(__name__)
 
 # --- FastAPI ---
-app = FastAPI(title="Evaluador LLM por ID")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.db = await asyncpg.create_pool(
+        **DB_CONFIG, min_size=2, max_size=int(os.getenv("DB_POOL_MAX", 16))
+    )
+    missing_writer = asyncio.create_task(_missing_writer())
+    yield
+    missing_writer.cancel()
+    await app.state.db.close()
+    await http_client.aclose()
+    await llm_cache.close()
+    _responses_fh.close()
+
+app = FastAPI(title="Evaluador LLM por ID", lifespan=lifespan)
 
 # --- Pydantic model ---
 class QuestionRequest(BaseModel):
@@ -34,25 +63,118 @@ DB_CONFIG = {
     "password": os.getenv("DB_PASSWORD", "password123")
 }
 
+# --- Redis (caché negativa de IDs inexistentes) ---
+# Usa el mismo cliente redis.asyncio que la caché LLM: un solo pool y sin threads
+MISSING_TTL = int(os.getenv("MISSING_TTL", 300))
+redis_client = llm_cache.redis_client
+
+async def is_known_missing(qid: int) -> bool:
+    try:
+        return bool(await redis_client.exists(f"question_missing:{qid}"))
+    except RedisError as e:
+        logger.warning(f"Redis no disponible: {e}")
+        return False
+
+# Escritura diferida: mark_missing solo encola; una task vacía la cola en lotes con un pipeline
+_missing_q = asyncio.Queue()
+MISSING_BATCH = 64
+
+async def _missing_writer():
+    while True:
+        ids = [await _missing_q.get()]
+        while len(ids) < MISSING_BATCH and not _missing_q.empty():
+            ids.append(_missing_q.get_nowait())
+        try:
+            async with redis_client.pipeline(transaction=False) as pipe:
+                for qid in ids:
+                    pipe.setex(f"question_missing:{qid}", MISSING_TTL, "1")
+                await pipe.execute()
+        except RedisError as e:
+            logger.warning(f"Redis no disponible: {e}")
+
+def mark_missing(qid: int):
+    _missing_q.put_nowait(qid)
+
 # --- LLM helper ---
-def call_llm(prompt: str, api_key: str, model="minimax/minimax-m2:free"):
+# Cliente HTTP asíncrono compartido por todos los requests: reutiliza conexiones TLS (HTTP/2) hacia OpenRouter
+OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
+http_client = httpx.AsyncClient(
+    http2=True,
+    timeout=60,
+    limits=httpx.Limits(max_keepalive_connections=32)
+)
+
+# Respuesta de OpenRouter decodificada y validada directo desde los bytes
+class ORMessage(msgspec.Struct):
+    content: str
+
+class ORChoice(msgspec.Struct):
+    message: ORMessage
+
+class ORResponse(msgspec.Struct):
+    choices: list[ORChoice]
+
+_decode_response = msgspec.json.Decoder(ORResponse).decode
+
+# Tope de llamadas simultáneas a OpenRouter por API key (relevante en /evaluate_batch)
+LLM_MAX_INFLIGHT = int(os.getenv("LLM_MAX_INFLIGHT", 20))
+_llm_slots = {}
+LLM_MODEL = "minimax/minimax-m2:free"
+
+async def call_llm(prompt: str, api_key: str, model=LLM_MODEL):
+    """Consulta la caché Redis (sha256 de modelo+prompt) antes de llamar a OpenRouter"""
+    return await llm_cache.get_or_set(prompt, model, lambda: _post_llm(prompt, api_key, model))
+
+async def _post_llm(prompt: str, api_key: str, model: str):
+    slots = _llm_slots.get(api_key)
+    if slots is None:
+        slots = _llm_slots[api_key] = asyncio.Semaphore(LLM_MAX_INFLIGHT)
     try:
-        client = OpenAI(base_url="https://openrouter.ai/api/v1", api_key=api_key)
-        completion = client.chat.completions.create(
-            model=model,
-            messages=[{"role": "user", "content": prompt}],
-            timeout=60
-        )
-        return completion.choices[0].message.content.strip()
+        async with slots:
+            response = await http_client.post(
+                OPENROUTER_URL,
+                headers={"Authorization": f"Bearer {api_key}"},
+                json={"model": model, "messages": [{"role": "user", "content": prompt}]}
+            )
+        response.raise_for_status()
+        return _decode_response(response.content).choices[0].message.content.strip()
     except Exception as e:
         logger.exception("Error llamando al modelo LLM")
         raise HTTPException(status_code=500, detail=f"Error LLM: {e}")
 
-def generate_llm_answer(question_text, api_key):
-    prompt = f"Responde de manera concisa:\n{question_text}"
-    return call_llm(prompt, api_key)
+def generation_prompt(question_text):
+    return f"Responde de manera concisa:\n{question_text}"
+
+async def generate_llm_answer(question_text, api_key):
+    return await call_llm(generation_prompt(question_text), api_key)
+
+# Puntajes del evaluador: strict=False acepta números como string ("0.8"); los que falten quedan en 0.5
+class Scores(msgspec.Struct):
+    similarity_score: float = 0.5
+    quality_score: float = 0.5
+    completeness_score: float = 0.5
+
+_decode_scores = msgspec.json.Decoder(Scores, strict=False).decode
+
+# Primer objeto JSON plano del texto (el modelo a veces lo envuelve en prosa o en ```json ... ```)
+_JSON_RE = re.compile(r"\{[^{}]*\}", re.S)
 
-def evaluate_response_with_llm(llm_answer, human_answer, api_key):
+def parse_scores(result_text):
+    """Devuelve los Scores extraídos del texto, o None si no hay un JSON de puntajes válido"""
+    text = result_text.strip()
+    try:
+        return _decode_scores(text)
+    except msgspec.DecodeError:
+        pass
+    m = _JSON_RE.search(text)
+    if m:
+        try:
+            return _decode_scores(m.group(0))
+        except msgspec.DecodeError:
+            pass
+    return None
+
+async def evaluate_response_with_llm(llm_answer, human_answer, api_key):
     prompt = f"""
 Evalúa la respuesta del MODELO comparada con la HUMANA.
 ### Modelo
@@ -61,79 +183,91 @@ Evalúa la respuesta del MODELO comparada con la HUMANA.
 {human_answer}
 Devuelve un JSON: similarity_score, quality_score, completeness_score
 """
-    result_text = call_llm(prompt, api_key)
-    try:
-        data = json.loads(result_text)
-        sim = float(data.get("similarity_score", 0.5))
-        qual = float(data.get("quality_score", 0.5))
-        comp = float(data.get("completeness_score", 0.5))
-    except Exception:
-        sim, qual, comp = 0.5, 0.5, 0.5
+    scores = parse_scores(await call_llm(prompt, api_key))
+    if scores is None:
+        # Un solo reintento con instrucciones más estrictas antes de caer al 0.5 por defecto
+        logger.warning("Respuesta de evaluación sin JSON válido, reintentando una vez")
+        strict = prompt + "Responde SOLO con el objeto JSON, sin texto adicional ni bloques de código.\n"
+        scores = parse_scores(await call_llm(strict, api_key)) or Scores()
+    sim, qual, comp = scores.similarity_score, scores.quality_score, scores.completeness_score
     overall = round(sim * 0.5 + qual * 0.3 + comp * 0.2, 6)
     return sim, qual, comp, overall
 
-def save_response_json(data: dict, filename="responses.json"):
-    base_path = os.path.dirname(os.path.abspath(__file__))
-    path = os.path.join(base_path, filename)
+# Archivo de respuestas abierto una sola vez (append-only); solo se escribe desde el event loop
+RESPONSES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "responses.jsonl")
+_responses_fh = open(RESPONSES_PATH, "ab")
+
+def save_response_json(data: dict):
+    """Agrega la respuesta como una línea JSON y la vacía a disco"""
     try:
-        if os.path.exists(path):
-            with open(path, "r", encoding="utf-8") as f:
-                all_data = json.load(f)
-        else:
-            all_data = []
-        all_data.append(data)
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump(all_data, f, ensure_ascii=False, indent=2)
+        _responses_fh.write(orjson.dumps(data) + b"\n")
+        _responses_fh.flush()
         logger.info(f"✅ Guardada respuesta success id={data['question_id']}")
     except Exception as e:
         logger.warning(f"No se pudo guardar JSON: {e}")
 
-# --- Endpoint HTTP ---
-@app.post("/evaluate")
-def evaluate_question(req: QuestionRequest):
+# --- Acceso a la DB (asyncpg: pool creado en el lifespan, statements preparados y cacheados por conexión) ---
+async def fetch_question(qid: int):
+    async with app.state.db.acquire() as conn:
+        return await conn.fetchrow("""
+            SELECT question_text, human_answer, llm_answer,
+                similarity_score, quality_score, completeness_score, overall_score
+            FROM questions WHERE id=$1
+        """, qid)
+
+async def store_evaluation(qid: int, llm_answer, sim, qual, comp):
+    """Guarda la evaluación y devuelve el overall_score que calculó Postgres (columna generada),
+    o None si la fila ya no existe"""
+    async with app.state.db.acquire() as conn:
+        # evaluated_at es TIMESTAMP sin zona: el servidor pone la hora local de Chile
+        return await conn.fetchval("""
+            UPDATE questions
+            SET llm_answer=$1, similarity_score=$2, quality_score=$3, completeness_score=$4,
+                evaluated_at=NOW() AT TIME ZONE 'America/Santiago'
+            WHERE id=$5
+            RETURNING overall_score
+        """, llm_answer, sim, qual, comp, qid)
+
+# --- Endpoints HTTP ---
+def get_api_key():
     api_keys = [k.strip() for k in os.getenv("OPENROUTER_API_KEY", "").split(",") if k.strip()]
     if not api_keys:
         raise HTTPException(status_code=500, detail="No se encontraron API keys")
-    key_to_use = api_keys[0]
+    return api_keys[0]
 
-    try:
-        conn = psycopg2.connect(**DB_CONFIG)
-        with conn.cursor() as cur:
-            cur.execute("""
-                SELECT question_text, human_answer, llm_answer,
-                    similarity_score, quality_score, completeness_score, overall_score
-                FROM questions WHERE id=%s
-            """, (req.id,))
-            row = cur.fetchone()
-            if not row:
-                raise HTTPException(status_code=404, detail=f"No se encontró la pregunta con id {req.id}")
-            question_text, human_answer, existing_llm_answer, existing_sim, existing_qual, existing_comp, existing_overall = row
-
-            if existing_llm_answer and existing_overall and existing_overall >= 0.7:
-                logger.info(f"♻️ Reutilizando respuesta previa id={req.id}")
-                response_data = {
-                    "id": req.id,
-                    "question_id": req.id,
-                    "question_text": question_text,
-                    "human_answer": human_answer,
-                    "llm_answer": existing_llm_answer,
-                    "similarity_score": existing_sim,
-                    "quality_score": existing_qual,
-                    "completeness_score": existing_comp,
-                    "overall_score": existing_overall,
-                    "evaluated_at": get_chile_time().isoformat()
-                }
-                save_response_json(response_data)
-                return response_data
-    finally:
-        if 'conn' in locals():
-            conn.close()
-
-    llm_answer = generate_llm_answer(question_text, key_to_use)
-    sim, qual, comp, overall = evaluate_response_with_llm(llm_answer, human_answer, key_to_use)
+async def evaluate_one(qid: int, key_to_use: str):
+    """Evalúa una pregunta: reutiliza la respuesta previa si es buena, si no genera → evalúa → guarda"""
+    if await is_known_missing(qid):
+        raise HTTPException(status_code=404, detail=f"No se encontró la pregunta con id {qid}")
+
+    row = await fetch_question(qid)
+    if not row:
+        mark_missing(qid)
+        raise HTTPException(status_code=404, detail=f"No se encontró la pregunta con id {qid}")
+    question_text, human_answer, existing_llm_answer, existing_sim, existing_qual, existing_comp, existing_overall = row
+
+    if existing_llm_answer and existing_overall and existing_overall >= 0.7:
+        logger.info(f"♻️ Reutilizando respuesta previa id={qid}")
+        response_data = {
+            "id": qid,
+            "question_id": qid,
+            "question_text": question_text,
+            "human_answer": human_answer,
+            "llm_answer": existing_llm_answer,
+            "similarity_score": existing_sim,
+            "quality_score": existing_qual,
+            "completeness_score": existing_comp,
+            "overall_score": existing_overall,
+            "evaluated_at": get_chile_time().isoformat()
+        }
+        save_response_json(response_data)
+        return response_data
+
+    llm_answer = await generate_llm_answer(question_text, key_to_use)
+    sim, qual, comp, overall = await evaluate_response_with_llm(llm_answer, human_answer, key_to_use)
     response_data = {
-        "id": req.id,
-        "question_id": req.id,
+        "id": qid,
+        "question_id": qid,
         "question_text": question_text,
         "human_answer": human_answer,
         "llm_answer": llm_answer,
@@ -145,19 +279,32 @@ def evaluate_question(req: QuestionRequest):
     }
 
     if overall >= 0.7:
-        try:
-            conn = psycopg2.connect(**DB_CONFIG)
-            with conn.cursor() as cur:
-                cur.execute("""
-                    UPDATE questions
-                    SET llm_answer=%s, similarity_score=%s, quality_score=%s, completeness_score=%s,
-                        overall_score=%s, evaluated_at=%s
-                    WHERE id=%s
-                """, (llm_answer, sim, qual, comp, overall, get_chile_time(), req.id))
-                conn.commit()
-        finally:
-            if 'conn' in locals():
-                conn.close()
+        stored_overall = await store_evaluation(qid, llm_answer, sim, qual, comp)
+        if stored_overall is not None:  # None: la fila ya no existe, se deja el overall calculado aquí
+            response_data["overall_score"] = stored_overall
         save_response_json(response_data)
-        logger.info(f"✅ Guardada respuesta id={req.id}")
+        logger.info(f"✅ Guardada respuesta id={qid}")
+    else:
+        # Respuesta bajo el umbral: se saca de la caché para que el reintento genere una nueva
+        await llm_cache.invalidate(generation_prompt(question_text), LLM_MODEL)
     return response_data
+
+@app.post("/evaluate")
+async def evaluate_question(req: QuestionRequest):
+    return await evaluate_one(req.id, get_api_key())
+
+@app.post("/evaluate_batch")
+async def evaluate_batch(ids: List[int]):
+    """Evalúa varios IDs en paralelo; cada ID sigue siendo generador → evaluador en serie"""
+    key_to_use = get_api_key()
+    results = await asyncio.gather(*(evaluate_one(qid, key_to_use) for qid in ids), return_exceptions=True)
+    out = []
+    for qid, res in zip(ids, results):
+        if isinstance(res, HTTPException):
+            out.append({"id": qid, "error": res.detail, "status_code": res.status_code})
+        elif isinstance(res, Exception):
+            logger.error(f"Error evaluando id={qid}: {res}")
+            out.append({"id": qid, "error": str(res), "status_code": 500})
+        else:
+            out.append(res)
+    return out
@@ -9,56 +9,105 @@ Cuenta:
 
 Uso:
   python count_answers.py --file path/to/grok_answers.json
+  python count_answers.py --file path/to/grok_answers.jsonl
 """
 
 import argparse
-import json
 import os
 from typing import Tuple, List, Union
 
-def load_json(path: str):
-    with open(path, "r", encoding="utf-8") as f:
-        return json.load(f)
+import ijson
+import orjson
 
-def analyze_mapping(data: dict) -> Tuple[int,int,List[str]]:
+def detect_layout(path: str):
+    """Devuelve "{" o "[" según el primer carácter significativo del archivo (None si no es ninguno)"""
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(4096)
+            if not chunk:
+                return None
+            stripped = chunk.lstrip()
+            if stripped:
+                c = stripped[:1].decode("ascii", "replace")
+                return c if c in "{[" else None
+
+def _has_answer(llm) -> bool:
+    return llm is not None and str(llm).strip() != ""
+
+def _scan(path: str, keyed: bool):
     """
-    data expected like { "1": { ... }, "2": { ... }, ... }
+    Recorre el JSON por eventos (ijson.parse) sin construir los objetos:
+    de cada elemento de primer nivel solo mira llm_answer (y el id en el formato lista).
+    keyed=True  -> { "1": {...}, ... }  (el ID es la clave)
+    keyed=False -> [ {"id": ..., ...}, ... ]
     """
     total = 0
     answered = 0
     empty_ids = []
-    for key, item in data.items():
-        if not isinstance(item, dict):
-            continue
-        total += 1
-        llm = item.get("llm_answer", None)
-        if llm is not None and str(llm).strip() != "":
-            answered += 1
-        else:
-            empty_ids.append(str(key))
+    item_prefix = None if keyed else "item"
+    llm_prefix = "item.llm_answer"
+    id_prefix = "item.id"
+    llm = None
+    item_id = "?"
+    with open(path, "rb") as f:
+        for prefix, event, value in ijson.parse(f):
+            if keyed and prefix == "" and event == "map_key":
+                item_prefix = value
+                llm_prefix = f"{value}.llm_answer"
+            elif prefix == item_prefix:
+                if event == "start_map":
+                    llm = None
+                    item_id = str(item_prefix) if keyed else "?"
+                elif event == "end_map":
+                    total += 1
+                    if _has_answer(llm):
+                        answered += 1
+                    else:
+                        empty_ids.append(item_id)
+            elif prefix == llm_prefix:
+                # escalar -> su valor; objeto/lista anidada -> cuenta como respuesta no vacía
+                if event in ("start_map", "start_array"):
+                    llm = event
+                elif event not in ("map_key", "end_map", "end_array"):
+                    llm = value
+            elif not keyed and prefix == id_prefix:
+                item_id = value
     return total, answered, empty_ids
 
-def analyze_list(data: list) -> Tuple[int,int,List[Union[int,str]]]:
+def analyze_mapping(path: str) -> Tuple[int,int,List[str]]:
+    """
+    data expected like { "1": { ... }, "2": { ... }, ... }
+    """
+    return _scan(path, keyed=True)
+
+def analyze_list(path: str) -> Tuple[int,int,List[Union[int,str]]]:
     """
     data expected like [ { "id":..., "llm_answer": ... }, ... ]
     """
-    total = 0
-    answered = 0
-    empty_ids = []
-    for item in data:
-        if not isinstance(item, dict):
-            continue
-        total += 1
-        llm = item.get("llm_answer", None)
-        if llm is not None and str(llm).strip() != "":
-            answered += 1
-        else:
-            empty_ids.append(item.get("id", "?"))
-    return total, answered, empty_ids
+    return _scan(path, keyed=False)
+
+def analyze_jsonl(path: str) -> Tuple[int,int,List[Union[int,str]]]:
+    """
+    una línea por registro: {"id": ..., "llm_answer": ..., ...}
+    (si un ID se repite vale la última línea, igual que al cargar el log en LLM_Client)
+    """
+    status = {}
+    with open(path, "rb") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                row = orjson.loads(line)
+            except orjson.JSONDecodeError:
+                continue  # línea cortada (escritura interrumpida)
+            status[row.get("id", "?")] = _has_answer(row.get("llm_answer"))
+    answered = sum(status.values())
+    empty_ids = [qid for qid, ok in status.items() if not ok]
+    return len(status), answered, empty_ids
 
 def main():
     parser = argparse.ArgumentParser(description="Cuenta preguntas totales y respondidas en un JSON de backup.")
-    parser.add_argument("--file", "-f", required=True, help="Ruta al JSON (ej: grok_answers.json)")
+    parser.add_argument("--file", "-f", required=True, help="Ruta al JSON o JSONL (ej: grok_answers.json)")
     args = parser.parse_args()
 
     path = args.file
@@ -66,12 +115,14 @@ def main():
         print(f"Error: archivo no encontrado: {path}")
         return
 
-    data = load_json(path)
+    layout = detect_layout(path)
 
-    if isinstance(data, dict):
-        total, answered, empty_ids = analyze_mapping(data)
-    elif isinstance(data, list):
-        total, answered, empty_ids = analyze_list(data)
+    if path.endswith(".jsonl"):
+        total, answered, empty_ids = analyze_jsonl(path)
+    elif layout == "{":
+        total, answered, empty_ids = analyze_mapping(path)
+    elif layout == "[":
+        total, answered, empty_ids = analyze_list(path)
     else:
         print("Formato JSON no reconocido. Debe ser un dict o una lista.")
         return
@@ -0,0 +1,47 @@
+import os
+import hashlib
+import logging
+import redis.asyncio as aioredis
+from redis.exceptions import RedisError
+
+# Caché exacta de respuestas LLM en Redis: llave = sha256(modelo|prompt), valor = texto devuelto por el modelo
+LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", 86400))
+
+logger = logging.getLogger(__name__)
+
+# Cliente compartido: app.py lo usa también para la caché negativa de IDs inexistentes
+redis_client = aioredis.Redis(
+    host=os.getenv("REDIS_HOST", "cache"),
+    port=int(os.getenv("REDIS_PORT", 6379)),
+    db=0,
+    decode_responses=True
+)
+
+def cache_key(prompt: str, model: str) -> str:
+    return "llm:" + hashlib.sha256(f"{model}|{prompt}".encode()).hexdigest()
+
+async def get_or_set(prompt: str, model: str, fetcher):
+    """Devuelve la respuesta cacheada; si no existe llama a fetcher() y la guarda con TTL.
+    Si Redis no está disponible se llama directo al modelo"""
+    key = cache_key(prompt, model)
+    try:
+        cached = await redis_client.get(key)
+        if cached is not None:
+            return cached
+    except RedisError as e:
+        logger.warning(f"Redis no disponible (caché LLM): {e}")
+    value = await fetcher()
+    try:
+        await redis_client.setex(key, LLM_CACHE_TTL, value)
+    except RedisError as e:
+        logger.warning(f"Redis no disponible (caché LLM): {e}")
+    return value
+
+async def invalidate(prompt: str, model: str):
+    try:
+        await redis_client.delete(cache_key(prompt, model))
+    except RedisError as e:
+        logger.warning(f"Redis no disponible (caché LLM): {e}")
+
+async def close():
+    await redis_client.aclose()
@@ -19,8 +19,17 @@ def copy_grok_to_localdata():
         print(f"❌ No se encontró el archivo en {source_path}")
         return
 
-    shutil.copy2(source_path, target_path)
-    print(f"✅ Archivo copiado a {target_path}")
+    if os.path.exists(target_path):
+        os.remove(target_path)
+    try:
+        # Mismo filesystem: hardlink, no se copia ningún byte
+        os.link(source_path, target_path)
+        print(f"✅ Archivo enlazado en {target_path}")
+    except OSError:
+        # Otro dispositivo (o sin soporte de hardlinks): copyfile usa sendfile en Linux
+        shutil.copyfile(source_path, target_path)
+        shutil.copystat(source_path, target_path)
+        print(f"✅ Archivo copiado a {target_path}")
 
 if __name__ == "__main__":
     copy_grok_to_localdata()